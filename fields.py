@@ -17,15 +17,41 @@
     The pack method takes a sequence of values and packs them into a list of
     bytes.  The method returns the packed list and any extra values as a
     tuple.
+
+    For speed, each field also has unpack_from and pack_into methods that
+    work like their struct module namesakes:  they read from or write to a
+    buffer (str, bytearray, memoryview, ...) at an offset rather than
+    shifting values off the front of a list.  A FieldList compiles itself in
+    to a Codec the first time these are used.
+
+    The decode method is the cursor-style version of unpack_from.  It takes
+    a buffer and an offset and returns the values along with the offset of
+    the next field, so a series of fields can be read out of a receive
+    buffer without the buffer ever being modified or copied.
+
+    If NumPy is installed, a FieldList can also describe itself as a NumPy
+    structured dtype and decode a block of same-format records in one go
+    (see FieldList.dtype and FieldList.unpack_many).
     """
 
 
+#******************************************************************************
+import struct
+
+# NumPy is optional, and slow to import, so it is only imported when array
+# decoding is first used (see Codec.array_plan).
+numpy = None
+
+
 #******************************************************************************
 LITTLE_ENDIAN = False
 BIG_ENDIAN = True
 
 DEFAULT_BYTE_ORDER = LITTLE_ENDIAN
 
+# struct module prefix for each byte order.
+_struct_order = {LITTLE_ENDIAN: '<', BIG_ENDIAN: '>'}
+
 
 #******************************************************************************
 class FieldError(Exception):
@@ -35,6 +61,9 @@ class FieldError(Exception):
 #******************************************************************************
 class Field:
 
+    # struct format character of the field, or None if there isn't one.
+    fmt = None
+
     #--------------------------------------------------------------------------
     def __init__(self, name, size):
         """ A field has a name and a size.  The size is in bytes.
@@ -43,6 +72,38 @@ class Field:
         self.size = size
 
 
+    #--------------------------------------------------------------------------
+    def unpack_from(self, buffer, offset=0):
+        """ Unpack the field from buffer, starting at offset, and return the
+            list of values.  The buffer is left untouched.
+            """
+        return list(self.struct.unpack_from(buffer, offset))
+
+
+    #--------------------------------------------------------------------------
+    def pack_into(self, buffer, offset, values):
+        """ Pack the sequence of values in to buffer, starting at offset.
+            """
+        self.struct.pack_into(buffer, offset, values[0] & self.mask)
+
+
+    #--------------------------------------------------------------------------
+    def decode(self, buffer, offset=0):
+        """ Unpack the field from buffer, starting at offset, and return the
+            list of values and the offset just past the field as a tuple.
+
+            If the buffer ends before the field does, the missing bytes are
+            read as zeroes.  Only the short tail is padded; the buffer itself
+            is never extended.
+            """
+        end = offset + self.size
+        if end > len(buffer):
+            tail = bytearray(buffer[offset:])
+            tail.extend(bytearray(end - offset - len(tail)))
+            return self.unpack_from(tail), end
+        return self.unpack_from(buffer, offset), end
+
+
 #******************************************************************************
 class Bitmask(Field):
     """ Naming utility.  This is the same as a field, but is implemented for
@@ -54,6 +115,11 @@ class Bitmask(Field):
 #******************************************************************************
 class Int8(Field):
 
+    fmt = 'B'
+    order = None
+    mask = 0xFF
+    struct = struct.Struct('B')
+
     #--------------------------------------------------------------------------
     def __init__(self, name):
         Field.__init__(self, name, 1)
@@ -74,10 +140,14 @@ class Int8(Field):
 #******************************************************************************
 class Int16(Field):
 
+    fmt = 'H'
+    mask = 0xFFFF
+
     #--------------------------------------------------------------------------
     def __init__(self, name, order=DEFAULT_BYTE_ORDER):
         Field.__init__(self, name, 2)
         self.order = order
+        self.struct = struct.Struct(_struct_order[order] + self.fmt)
 
 
     #--------------------------------------------------------------------------
@@ -108,6 +178,10 @@ class Int24(Field):
     def __init__(self, name, order=DEFAULT_BYTE_ORDER):
         Field.__init__(self, name, 3)
         self.order = order
+        if order == LITTLE_ENDIAN:
+            self.struct = struct.Struct('<HB')
+        else:
+            self.struct = struct.Struct('>BH')
 
 
     #--------------------------------------------------------------------------
@@ -132,13 +206,38 @@ class Int24(Field):
         return b, values
 
 
+    #--------------------------------------------------------------------------
+    def unpack_from(self, buffer, offset=0):
+        """ struct has no 3-byte integer, so the value is read as a 16-bit
+            and an 8-bit integer and then combined.
+            """
+        if self.order == LITTLE_ENDIAN:
+            lo, hi = self.struct.unpack_from(buffer, offset)
+        else:
+            hi, lo = self.struct.unpack_from(buffer, offset)
+        return [lo | (hi << 16)]
+
+
+    #--------------------------------------------------------------------------
+    def pack_into(self, buffer, offset, values):
+        val = values[0]
+        if self.order == LITTLE_ENDIAN:
+            self.struct.pack_into(buffer, offset, val & 0xFFFF, (val >> 16) & 0xFF)
+        else:
+            self.struct.pack_into(buffer, offset, (val >> 16) & 0xFF, val & 0xFFFF)
+
+
 #******************************************************************************
 class Int32(Field):
 
+    fmt = 'I'
+    mask = 0xFFFFFFFF
+
     #--------------------------------------------------------------------------
     def __init__(self, name, order=DEFAULT_BYTE_ORDER):
         Field.__init__(self, name, 4)
         self.order = order
+        self.struct = struct.Struct(_struct_order[order] + self.fmt)
 
 
     #--------------------------------------------------------------------------
@@ -182,12 +281,19 @@ class FieldList(Field):
         self.name = name
         self.size = sum([f.size for f in lst])
         self.fields = lst
+        self.field_names = tuple(self.names())
+        self.codec = None
+        self.record_type = None
+        self.lazy_record_type = None
 
 
     #--------------------------------------------------------------------------
     def names(self):
         """ Return a list of the field names.  The list is ordered according
             to the data order.
+
+            The same names are kept in the field_names tuple, which is the
+            cheaper option when the list is not going to be modified.
             """
         name_list = []
         for f in self.fields:
@@ -198,15 +304,62 @@ class FieldList(Field):
         return name_list
 
 
+    #--------------------------------------------------------------------------
+    def compile(self):
+        """ Return the Codec for this field list.  The codec is built the
+            first time it is asked for and is reused after that.
+            """
+        if self.codec is None:
+            self.codec = Codec(self)
+        return self.codec
+
+
+    #--------------------------------------------------------------------------
+    def record_class(self):
+        """ Return the SlotRecord subclass for this field list.  The class is
+            generated the first time it is asked for and is reused after that.
+            """
+        if self.record_type is None:
+            self.record_type = SlotRecord.make_class(self)
+        return self.record_type
+
+
+    #--------------------------------------------------------------------------
+    def lazy_record_class(self):
+        """ Return the LazyRecord subclass for this field list.  The class is
+            generated the first time it is asked for and is reused after that.
+            """
+        if self.lazy_record_type is None:
+            self.lazy_record_type = LazyRecord.make_class(self)
+        return self.lazy_record_type
+
+
+    #--------------------------------------------------------------------------
+    def offsets(self):
+        """ Return a dictionary that maps each field name to an (offset,
+            field, index) tuple, where offset is the byte offset of the field
+            that holds the value and index is the position of the value in
+            the list that field unpacks (always 0 except for Bitfields).
+            """
+        table = {}
+        offset = 0
+        for f in Codec.flatten(self):
+            if isinstance(f, Bitfield):
+                for i, n in enumerate(f.field_names):
+                    table[n] = (offset, f, i)
+            else:
+                table[f.name] = (offset, f, 0)
+            offset += f.size
+        return table
+
+
     #--------------------------------------------------------------------------
     def unpack(self, bytes):
         """ Similar to the unpack method for the Field object except a series
             of Fields and FieldLists can be unpacked.
             """
-        vals = []
-        for f in self.fields:
-            v, bytes = f.unpack(bytes)
-            vals.extend(v)
+        vals = self.compile().unpack_from(bytearray(bytes[:self.size]))
+        del bytes[:self.size]
         return vals, bytes
 
 
@@ -215,11 +368,44 @@ class FieldList(Field):
         """ Similar to the pack method for the Field object except a series
             of Fields and FieldLists can be packed.
             """
-        bytes = []
-        for f in self.fields:
-            b, values = f.pack(values)
-            bytes.extend(b)
-        return bytes, values
+        codec = self.compile()
+        bytes = bytearray(self.size)
+        codec.pack_into(bytes, 0, values[:codec.count])
+        del values[:codec.count]
+        return list(bytes), values
+
+
+    #--------------------------------------------------------------------------
+    def dtype(self):
+        """ Return the NumPy structured dtype of the decoded field list:  one
+            unsigned integer column per value, Bitfield members included.
+            """
+        return self.compile().array_plan()[1]
+
+
+    #--------------------------------------------------------------------------
+    def unpack_many(self, buffer, count=-1, offset=0):
+        """ Decode count back-to-back records from buffer, starting at offset,
+            in to a NumPy structured array (see dtype).  A count of -1 decodes
+            as many complete records as the buffer holds.
+            """
+        return self.compile().unpack_many(buffer, count, offset)
+
+
+    #--------------------------------------------------------------------------
+    def unpack_from(self, buffer, offset=0):
+        """ Unpack the field list from buffer, starting at offset, using the
+            compiled codec.  Return the list of values.
+            """
+        return self.compile().unpack_from(buffer, offset)
+
+
+    #--------------------------------------------------------------------------
+    def pack_into(self, buffer, offset, values):
+        """ Pack the sequence of values in to buffer, starting at offset,
+            using the compiled codec.
+            """
+        self.compile().pack_into(buffer, offset, values)
 
 
 #******************************************************************************
@@ -251,7 +437,8 @@ class Bitfield(FieldList):
         self.name = name
         self.order = order
         self.fields = lst
-        size = (sum([f.size for f in lst]) + 7) / 8
+        self.field_names = tuple([f.name for f in lst])
+        size = (sum([f.size for f in lst]) + 7) // 8
         if size == 1:
             self.helper = Int8(None)
         elif size == 2:
@@ -264,6 +451,33 @@ class Bitfield(FieldList):
             raise FieldError('Maximum bitfield width of 32 exceeded.')
         self.size = self.helper.size
 
+        # The (shift, mask) pair of each member, worked out once.
+        plan = []
+        shift = 0
+        for f in lst:
+            plan.append((shift, Bitfield.width_table[f.size]))
+            shift += f.size
+        self.plan = tuple(plan)
+
+
+    #--------------------------------------------------------------------------
+    def decode_int(self, total):
+        """ Split the integer value of the whole bitfield in to the list of
+            member values.
+            """
+        return [(total >> shift) & mask for shift, mask in self.plan]
+
+
+    #--------------------------------------------------------------------------
+    def encode_int(self, values):
+        """ Combine a sequence of member values in to the integer value of the
+            whole bitfield.
+            """
+        total = 0
+        for (shift, mask), v in zip(self.plan, values):
+            total |= (v & mask) << shift
+        return total
+
 
     #--------------------------------------------------------------------------
     def unpack(self, bytes):
@@ -271,12 +485,7 @@ class Bitfield(FieldList):
             of bit-granular Fields and FieldLists can be unpacked.
             """
         total, bytes = self.helper.unpack(bytes)
-        total = total[0]
-        vals = []
-        for f in [f.size for f in self.fields]:
-            vals.append(total & Bitfield.width_table[f])
-            total >>= f
-        return vals, bytes
+        return self.decode_int(total[0]), bytes
 
 
     #--------------------------------------------------------------------------
@@ -284,13 +493,262 @@ class Bitfield(FieldList):
         """ Similar to the pack method for the Field object except a series
             of bit-granular Fields and FieldLists can be packed.
             """
-        val = 0
+        b, _ = self.helper.pack([self.encode_int(values[:len(self.plan)])])
+        del values[:len(self.plan)]
+        return b, values
+
+
+    #--------------------------------------------------------------------------
+    def unpack_from(self, buffer, offset=0):
+        return self.decode_int(self.helper.unpack_from(buffer, offset)[0])
+
+
+    #--------------------------------------------------------------------------
+    def pack_into(self, buffer, offset, values):
+        self.helper.pack_into(buffer, offset, [self.encode_int(values)])
+
+
+#******************************************************************************
+class Codec:
+    """ Compiled form of a FieldList.
+
+        The field list is flattened and each run of neighbouring fields that
+        have a struct format character (and agree on byte order) is merged in
+        to a single struct.Struct.  A Bitfield joins the run as its helper
+        integer, which is then split with Bitfield.decode_int.  Fields without
+        a struct equivalent, i.e. Int24 and 24-bit Bitfields, fall back to
+        their own unpack_from and pack_into methods.
+
+        A codec is obtained from FieldList.compile() rather than being
+        created directly.
+        """
+
+    #--------------------------------------------------------------------------
+    def __init__(self, field_list):
+        self.size = field_list.size
+        self.count = 0
+        self.leaves = Codec.flatten(field_list)
+        self.arrays = None
+
+        # Each step is a (packer, size, count, masks, bitfields) tuple.  The
+        # packer is either a struct.Struct or a field object.  For a struct,
+        # masks is a tuple of masks for its values and bitfields is None or
+        # a tuple holding the Bitfield (or None) behind each of its values.
+        # For a field object, masks and bitfields are both None.
+        self.steps = []
+        run = []
+        order = None
+        for f in self.leaves:
+            packer = f
+            if isinstance(f, Bitfield):
+                packer = f.helper
+
+            if packer.fmt is not None and (order is None or packer.order in (None, order)):
+                run.append((packer, f))
+                if packer.order is not None:
+                    order = packer.order
+                continue
+
+            self.add_struct(order, run)
+            if packer.fmt is not None:
+                run, order = [(packer, f)], packer.order
+            else:
+                run, order = [], None
+                count = isinstance(f, FieldList) and len(f.field_names) or 1
+                self.steps.append((f, f.size, count, None, None))
+                self.count += count
+        self.add_struct(order, run)
+
+        # Most field lists boil down to a single struct.
+        if len(self.steps) == 1 and self.steps[0][3] is not None \
+                and self.steps[0][4] is None:
+            self.struct = self.steps[0][0]
+        else:
+            self.struct = None
+
+
+    #--------------------------------------------------------------------------
+    def flatten(field_list):
+        """ Return the fields of a (possibly nested) field list in data order.
+            Bitfields are not flattened as their members are not byte-sized.
+            """
+        lst = []
+        for f in field_list.fields:
+            if isinstance(f, FieldList) and not isinstance(f, Bitfield):
+                lst.extend(Codec.flatten(f))
+            else:
+                lst.append(f)
+        return lst
+
+    flatten = staticmethod(flatten)
+
+
+    #--------------------------------------------------------------------------
+    def add_struct(self, order, run):
+        """ Add a struct step for a run of (packer, field) pairs.
+            """
+        if not run:
+            return
+        if order is None:
+            order = DEFAULT_BYTE_ORDER
+        s = struct.Struct(_struct_order[order] + ''.join([p.fmt for p, f in run]))
+        masks = tuple([p.mask for p, f in run])
+        bitfields = None
+        count = len(run)
+        if [f for p, f in run if p is not f]:
+            bitfields = tuple([p is not f and f or None for p, f in run])
+            count = sum([b and len(b.plan) or 1 for b in bitfields])
+        self.steps.append((s, s.size, count, masks, bitfields))
+        self.count += count
+
+
+    #--------------------------------------------------------------------------
+    def unpack_from(self, buffer, offset=0):
+        """ Unpack all of the fields from buffer, starting at offset, and
+            return the list of values.
+            """
+        if self.struct is not None:
+            return list(self.struct.unpack_from(buffer, offset))
+        vals = []
+        for packer, size, count, masks, bitfields in self.steps:
+            if bitfields is None:
+                vals.extend(packer.unpack_from(buffer, offset))
+            else:
+                for v, b in zip(packer.unpack_from(buffer, offset), bitfields):
+                    if b is None:
+                        vals.append(v)
+                    else:
+                        vals.extend(b.decode_int(v))
+            offset += size
+        return vals
+
+
+    #--------------------------------------------------------------------------
+    def pack_into(self, buffer, offset, values):
+        """ Pack the sequence of values in to buffer, starting at offset.
+            Values are truncated to the width of their fields.
+            """
+        idx = 0
+        for packer, size, count, masks, bitfields in self.steps:
+            vals = values[idx:idx + count]
+            if masks is None:
+                packer.pack_into(buffer, offset, vals)
+            elif bitfields is None:
+                packer.pack_into(buffer, offset,
+                        *[v & m for v, m in zip(vals, masks)])
+            else:
+                raw = []
+                i = 0
+                for m, b in zip(masks, bitfields):
+                    if b is None:
+                        raw.append(vals[i] & m)
+                        i += 1
+                    else:
+                        raw.append(b.encode_int(vals[i:i + len(b.plan)]))
+                        i += len(b.plan)
+                packer.pack_into(buffer, offset, *raw)
+            idx += count
+            offset += size
+
+
+    #--------------------------------------------------------------------------
+    def array_plan(self):
+        """ Work out (once) what unpack_many needs and return it as a tuple:
+            the packed dtype of the raw records, the dtype of the decoded
+            array and a list of (raw column, field, decoded columns) tuples.
+
+            Int8, Int16 and Int32 map directly on to NumPy integers.  Int24
+            and Bitfield are read as raw bytes and then combined and split.
+            """
+        if self.arrays is not None:
+            return self.arrays
+        global numpy
+        if numpy is None:
+            try:
+                import numpy
+            except ImportError:
+                raise ImportError('NumPy is required for array decoding.')
+
+        raw_names, raw_formats, raw_offsets = [], [], []
+        names, formats = [], []
+        columns = []
         offset = 0
-        for f in [f.size for f in self.fields]:
-            val |= (values.pop(0) & Bitfield.width_table[f]) << offset
-            offset += f
-        values.insert(0, val)
-        return self.helper.pack(values)
+        for i, f in enumerate(self.leaves):
+            raw_name = '_%d' % i
+            raw_names.append(raw_name)
+            raw_offsets.append(offset)
+            if f.fmt is not None:
+                raw_formats.append('%su%d' % (_struct_order.get(f.order, '|'), f.size))
+            else:
+                raw_formats.append(('u1', (f.size,)))
+
+            if isinstance(f, Bitfield):
+                col_names = []
+                for m in f.fields:
+                    col_names.append(m.name or 'f%d' % len(names))
+                    names.append(col_names[-1])
+                    formats.append('u%d' % Codec.uint_size(m.size))
+            else:
+                col_names = [f.name or 'f%d' % len(names)]
+                names.append(col_names[0])
+                formats.append('u%d' % Codec.uint_size(f.size * 8))
+            columns.append((raw_name, f, col_names))
+            offset += f.size
+
+        raw_dtype = numpy.dtype({'names' : raw_names, 'formats' : raw_formats,
+                'offsets' : raw_offsets, 'itemsize' : self.size})
+        self.arrays = (raw_dtype, numpy.dtype(list(zip(names, formats))), columns)
+        return self.arrays
+
+
+    #--------------------------------------------------------------------------
+    def uint_size(bits):
+        """ Return the size in bytes of the smallest NumPy unsigned integer
+            that holds the given number of bits.
+            """
+        for size in (1, 2, 4):
+            if bits <= size * 8:
+                return size
+        return 8
+
+    uint_size = staticmethod(uint_size)
+
+
+    #--------------------------------------------------------------------------
+    def unpack_many(self, buffer, count=-1, offset=0):
+        """ Decode count back-to-back records from buffer, starting at offset,
+            in to a NumPy structured array.  A count of -1 decodes as many
+            complete records as the buffer holds.
+            """
+        raw_dtype, dtype, columns = self.array_plan()
+        if count < 0:
+            count = self.size and (len(buffer) - offset) // self.size
+        if self.size == 0:
+            return numpy.zeros(count, dtype)
+
+        raw = numpy.frombuffer(buffer, raw_dtype, count, offset)
+        result = numpy.empty(count, dtype)
+        for raw_name, f, col_names in columns:
+            col = raw[raw_name]
+            if f.fmt is not None:
+                result[col_names[0]] = col
+                continue
+
+            # Combine the raw bytes in to a single integer per record.
+            total = numpy.zeros(count, 'u4')
+            for i in range(f.size):
+                if f.order == LITTLE_ENDIAN:
+                    shift = 8 * i
+                else:
+                    shift = 8 * (f.size - 1 - i)
+                total |= col[:, i].astype('u4') << shift
+
+            if isinstance(f, Bitfield):
+                for (shift, mask), name in zip(f.plan, col_names):
+                    result[name] = (total >> shift) & mask
+            else:
+                result[col_names[0]] = total
+        return result
 
 
 #******************************************************************************
@@ -315,16 +773,32 @@ class Record:
             This is the method that should be used to create Record objects
             as opposed to the normal Record() method.
             """
-        r = Record(field_list)
         if bytes is None:
-            bytes = [0] * (field_list.size)
-        else:
-            bytes.extend([0] * (field_list.size - len(bytes)))
-        vals, extra = r.unpack(bytes)
-        return r, extra
+            bytes = []
+        r, _ = Record.decode(field_list, bytearray(bytes[:field_list.size]))
+        del bytes[:field_list.size]
+        return r, bytes
 
     create = staticmethod(create)
 
+
+    #--------------------------------------------------------------------------
+    def decode(field_list, buffer, offset=0):
+        """ Create a record from the data in buffer (str, bytearray,
+            memoryview, ...) starting at offset.  The buffer is neither
+            modified nor copied and, as with create, any bytes missing from
+            the end of it are taken to be zeroes.
+
+            Return the created record and the offset just past the record's
+            data as a tuple.
+            """
+        r = Record(field_list)
+        vals, offset = field_list.decode(buffer, offset)
+        r.values = dict(zip(field_list.field_names, vals))
+        return r, offset
+
+    decode = staticmethod(decode)
+
     #--------------------------------------------------------------------------
     def __init__(self, field_list):
         self.fields = field_list
@@ -338,7 +812,7 @@ class Record:
             Return the list of values and the extra data as a tuple.
             """
         vals, extra = self.fields.unpack(bytes)
-        self.values = dict(zip(self.fields.names(), vals))
+        self.values = dict(zip(self.fields.field_names, vals))
         return vals, extra
 
 
@@ -349,7 +823,7 @@ class Record:
             return the resulting sequence of bytes (and extra data) as a tuple.
             """
         self.set(**values)
-        return self.fields.pack([self.values[f] for f in self.fields.names()])
+        return self.fields.pack([self.values[f] for f in self.fields.field_names])
 
 
     #--------------------------------------------------------------------------
@@ -391,9 +865,317 @@ class Record:
         except KeyError:
             return 0
 
+    #--------------------------------------------------------------------------
+    def __contains__(self, key):
+        return key in self.values
+
+    #--------------------------------------------------------------------------
+    def __iter__(self):
+        """ Allow iteration over the record's field names.
+            """
+        return iter(self.values)
+
+
+
+#******************************************************************************
+class SlotRecord(object):
+    """ Compact Record.
+
+        A SlotRecord has the same dictionary-style API as a Record, but rather
+        than a dictionary per record, the values are kept in __slots__ of a
+        class that is generated for each FieldList (see
+        FieldList.record_class).  The field order and the name to slot mapping
+        are worked out once, when the class is generated, and are shared by
+        all of its records.
+
+        Unlike a Record, the values attribute is a read-only copy of the data
+        and assigning to an unknown field name is ignored.
+        """
+
+    __slots__ = ()
+
+    # Filled in for each generated class.
+    fields = None
+    field_names = ()
+    slot_names = ()
+    slot_from_name = {}
+
+    #--------------------------------------------------------------------------
+    def make_class(cls, field_list):
+        """ Generate a subclass of this class for a field list.  Use
+            FieldList.record_class() rather than calling this directly.
+            """
+        slots = tuple(['_%d' % i for i in range(len(field_list.field_names))])
+        return type('%s%s' % (field_list.name or '', cls.__name__), (cls,), {
+                '__slots__' : slots,
+                'fields' : field_list,
+                'field_names' : field_list.field_names,
+                'slot_names' : slots,
+                'slot_from_name' : dict(zip(field_list.field_names, slots)),
+                })
+
+    make_class = classmethod(make_class)
+
+    #--------------------------------------------------------------------------
+    def create(cls, bytes=None):
+        """ Create a record of this class.  The same as Record.create except
+            that the field list is implied by the class.
+            """
+        if bytes is None:
+            bytes = []
+        r, _ = cls.decode(bytearray(bytes[:cls.fields.size]))
+        del bytes[:cls.fields.size]
+        return r, bytes
+
+    create = classmethod(create)
+
+    #--------------------------------------------------------------------------
+    def decode(cls, buffer, offset=0):
+        """ Create a record of this class from the data in buffer starting at
+            offset.  The same as Record.decode except that the field list is
+            implied by the class.
+            """
+        vals, offset = cls.fields.decode(buffer, offset)
+        return cls(vals), offset
+
+    decode = classmethod(decode)
+
+    #--------------------------------------------------------------------------
+    def __init__(self, vals=None):
+        """ Create a record from a sequence of values in field order.  If no
+            values are given, all fields are zero.
+            """
+        if vals is None:
+            vals = [0] * len(self.slot_names)
+        for s, v in zip(self.slot_names, vals):
+            setattr(self, s, v)
+
+
+    #--------------------------------------------------------------------------
+    def value_list(self):
+        """ Return a list of the record's values in field order.
+            """
+        return [getattr(self, s) for s in self.slot_names]
+
+
+    #--------------------------------------------------------------------------
+    def values(self):
+        """ A dictionary of the record's data.  This is a copy, so changes to
+            it do not affect the record.
+            """
+        return dict(zip(self.field_names, self.value_list()))
+
+    values = property(values)
+
+    #--------------------------------------------------------------------------
+    def unpack(self, bytes):
+        """ Unpack the sequence of bytes into the record's fields and keep
+            track of any extra data.
+
+            Return the list of values and the extra data as a tuple.
+            """
+        vals, extra = self.fields.unpack(bytes)
+        for s, v in zip(self.slot_names, vals):
+            setattr(self, s, v)
+        return vals, extra
+
+
+    #--------------------------------------------------------------------------
+    def pack(self, **values):
+        """ Pack whatever fields are provided in the keyword arguments (values)
+            along with whatever data is already present in the record and
+            return the resulting sequence of bytes (and extra data) as a tuple.
+            """
+        self.set(**values)
+        return self.fields.pack(self.value_list())
+
+
+    #--------------------------------------------------------------------------
+    def get(self, *names):
+        """ Return the data that corresponds to the specified field names.
+
+            Return the results as a dictionary.
+            """
+        rslt = {}.fromkeys(names, 0)
+        for n in rslt:
+            if n in self.slot_from_name:
+                rslt[n] = getattr(self, self.slot_from_name[n])
+        return rslt
+
+    #--------------------------------------------------------------------------
+    def set(self, **values):
+        """ Set values for the fields that are specified in the provided
+            keyword arguments.
+            """
+        for v in values:
+            if v in self.slot_from_name:
+                setattr(self, self.slot_from_name[v], values[v])
+
+    #--------------------------------------------------------------------------
+    def __setitem__(self, key, value):
+        """ Allow dictionary-type write access to the record data.
+            """
+        try:
+            setattr(self, self.slot_from_name[key], value)
+        except KeyError:
+            pass
+
+    #--------------------------------------------------------------------------
+    def __getitem__(self, key):
+        """ Allow dictionary-type read access to the record data.
+            """
+        try:
+            return getattr(self, self.slot_from_name[key])
+        except KeyError:
+            return 0
+
+    #--------------------------------------------------------------------------
+    def __contains__(self, key):
+        return key in self.slot_from_name
+
     #--------------------------------------------------------------------------
     def __iter__(self):
         """ Allow iteration over the record's field names.
             """
-        return self.values.iterkeys()
+        return iter(self.field_names)
+
+
+#******************************************************************************
+class LazyRecord(SlotRecord):
+    """ SlotRecord that decodes on demand.
+
+        A LazyRecord keeps a copy of the raw bytes it was decoded from and
+        only unpacks a field the first time that field is read.  The result
+        is cached in the field's slot, so slots that have not been filled in
+        are the fields that have not been decoded yet.
+
+        Packing a record that has not been modified is a straight copy of the
+        raw bytes.
+
+        As with SlotRecord, use FieldList.lazy_record_class() to get the class
+        for a field list.
+        """
+
+    __slots__ = ('raw', 'modified')
+
+    # Filled in for each generated class:  see FieldList.offsets().
+    layout = {}
+
+    #--------------------------------------------------------------------------
+    def make_class(cls, field_list):
+        rec_cls = super(LazyRecord, cls).make_class(field_list)
+        rec_cls.layout = field_list.offsets()
+        return rec_cls
+
+    make_class = classmethod(make_class)
+
+    #--------------------------------------------------------------------------
+    def decode(cls, buffer, offset=0):
+        """ Create a record of this class from the data in buffer starting at
+            offset.  Nothing is unpacked yet; the record's bytes are simply
+            copied out of the buffer.
+
+            Return the created record and the offset just past the record's
+            data as a tuple.
+            """
+        end = offset + cls.fields.size
+        r = cls()
+        r.raw = bytearray(buffer[offset:end])
+        return r, end
+
+    decode = classmethod(decode)
+
+    #--------------------------------------------------------------------------
+    def __init__(self, vals=None):
+        """ Create a record from a sequence of values in field order.  If no
+            values are given, all fields are zero.
+            """
+        self.raw = bytearray()
+        self.modified = vals is not None
+        if vals is not None:
+            SlotRecord.__init__(self, vals)
+
+
+    #--------------------------------------------------------------------------
+    def load(self, name):
+        """ Decode a single field from the raw bytes, cache it and return
+            its value.
+            """
+        offset, field, index = self.layout[name]
+        val = field.decode(self.raw, offset)[0][index]
+        setattr(self, self.slot_from_name[name], val)
+        return val
+
+
+    #--------------------------------------------------------------------------
+    def value_list(self):
+        """ Return a list of the record's values in field order.
+            """
+        return [self[n] for n in self.field_names]
+
 
+    #--------------------------------------------------------------------------
+    def unpack(self, bytes):
+        """ Take the record's raw bytes from the front of the sequence of
+            bytes, dropping any previously decoded values.
+
+            Return the list of values and the extra data as a tuple.
+            """
+        for s in self.slot_names:
+            try:
+                delattr(self, s)
+            except AttributeError:
+                pass
+        self.raw = bytearray(bytes[:self.fields.size])
+        self.modified = False
+        del bytes[:self.fields.size]
+        return self.value_list(), bytes
+
+
+    #--------------------------------------------------------------------------
+    def pack(self, **values):
+        """ Pack whatever fields are provided in the keyword arguments (values)
+            along with whatever data is already present in the record and
+            return the resulting sequence of bytes (and extra data) as a tuple.
+            """
+        self.set(**values)
+        if self.modified:
+            return self.fields.pack(self.value_list())
+        data = bytearray(self.raw)
+        data.extend(bytearray(self.fields.size - len(data)))
+        return list(data), []
+
+
+    #--------------------------------------------------------------------------
+    def get(self, *names):
+        rslt = {}.fromkeys(names, 0)
+        for n in rslt:
+            if n in self.slot_from_name:
+                rslt[n] = self[n]
+        return rslt
+
+    #--------------------------------------------------------------------------
+    def set(self, **values):
+        for v in values:
+            if v in self.slot_from_name:
+                setattr(self, self.slot_from_name[v], values[v])
+                self.modified = True
+
+    #--------------------------------------------------------------------------
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, self.slot_from_name[key], value)
+            self.modified = True
+        except KeyError:
+            pass
+
+    #--------------------------------------------------------------------------
+    def __getitem__(self, key):
+        try:
+            slot = self.slot_from_name[key]
+        except KeyError:
+            return 0
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            return self.load(key)
@@ -10,9 +10,17 @@
 
     The 01 is the packet type and 02, 03, and 0F is the packet data.  A
     packet is always delimited by a newline character (in string form).
+
+    A packet can also be sent in binary (frame) form:  a 2-byte big-endian
+    length followed by the type and data bytes.  A connection starts out in
+    string form and switches to frames once the BINARY_HANDSHAKE line has
+    been sent (see PacketReader).
     """
 
 #******************************************************************************
+import binascii
+import struct
+
 from fields import Field, FieldList, Int8
 
 
@@ -27,6 +35,18 @@ from fields import Field, FieldList, Int8
         TYPE_NVM,
         TYPE_TRPC) = range(7)
 
+# Packets of this type never go on the serial bus.  Their data is a command
+# for the packet server, as ASCII text (see packserv.py).
+TYPE_CONTROL = 0xFF
+
+
+#******************************************************************************
+# Line that switches a connection from string form to binary frames.
+BINARY_HANDSHAKE = b'!BINARY\n'
+
+# Length prefix of a binary frame.
+_frame_header = struct.Struct('>H')
+
 
 #******************************************************************************
 class Packet:
@@ -49,9 +69,11 @@ class Packet:
         """ Create a string-representation of the packet (see the docs for the
             module.
             """
-        lst = ['%02X' % b for b in self.joined()]
-        lst.append('\n')
-        return ''.join(lst)
+        s = binascii.hexlify(self.tobytes()).upper()
+        if not isinstance(s, str):
+            # Python 3:  hexlify returns bytes.
+            s = s.decode('ascii')
+        return s + '\n'
 
     
     #--------------------------------------------------------------------------
@@ -64,18 +86,146 @@ class Packet:
         return lst
 
 
+    #--------------------------------------------------------------------------
+    def tobytes(self):
+        """ Join the type and data into a single bytearray and return the
+            result.
+            """
+        b = bytearray(1)
+        b[0] = self.type
+        b.extend(self.data)
+        return b
+
+
+    #--------------------------------------------------------------------------
+    def to_frame(self):
+        """ Create the binary frame form of the packet (see the docs for the
+            module) and return it as a bytearray.
+            """
+        b = bytearray(3)
+        _frame_header.pack_into(b, 0, len(self.data) + 1)
+        b[2] = self.type
+        b.extend(self.data)
+        return b
+
+
     #--------------------------------------------------------------------------
     def from_str(s):
         """ Convert a packet in string form (see the module docs) into a
-            a packet object and return the result.
+            a packet object and return the result.  The packet's data is a
+            bytearray.
+
+            ValueError is raised if the string is not made up of hex digits.
             """
-        ln = len(s)
-        if ln & 1: ln -= 1
-        if ln == 0:
+        data = Packet.bytes_from_str(s)
+        if len(data) == 0:
             return Packet()
-        type, data = Packet.format.unpack(map(lambda x: int(x, 16), \
-                [s[idx:idx+2] for idx in range(0, ln, 2)]))
-        return Packet(type[0], data)
+        return Packet(data[0], data[1:])
 
     from_str = staticmethod(from_str)
 
+
+    #--------------------------------------------------------------------------
+    def bytes_from_str(s):
+        """ Convert a packet in string form into a bytearray of its type and
+            data, without making a packet object.  A trailing odd digit is
+            ignored, and a blank string gives an empty bytearray.
+
+            ValueError is raised if the string is not made up of hex digits.
+            """
+        s = s.rstrip()
+        ln = len(s)
+        if ln & 1: ln -= 1
+        try:
+            return bytearray(binascii.unhexlify(s[:ln]))
+        except (TypeError, binascii.Error):
+            raise ValueError('Invalid packet string: %r' % s)
+
+    bytes_from_str = staticmethod(bytes_from_str)
+
+
+    #--------------------------------------------------------------------------
+    def from_lines(buffer):
+        """ Convert every complete (newline-terminated) packet string in a
+            receive buffer into a packet object.  Blank lines and lines that
+            are not valid packet strings are skipped.
+
+            Return the list of packets and the unused tail of the buffer,
+            i.e. the start of a packet string whose newline has not arrived
+            yet, as a tuple.
+            """
+        end = buffer.rfind(b'\n') + 1
+        packets = []
+        for s in buffer[:end].split():
+            try:
+                packets.append(Packet.from_str(s))
+            except ValueError:
+                pass
+        return packets, buffer[end:]
+
+    from_lines = staticmethod(from_lines)
+
+
+    #--------------------------------------------------------------------------
+    def from_frames(buffer):
+        """ Convert every complete binary frame in a receive buffer into a
+            packet object.  Empty frames are skipped.
+
+            Return the list of packets and the unused tail of the buffer,
+            i.e. the start of a frame that has not fully arrived yet, as a
+            tuple.
+            """
+        if not isinstance(buffer, bytearray):
+            buffer = bytearray(buffer)
+        packets = []
+        offset = 0
+        end = len(buffer)
+        while offset + 2 <= end:
+            ln = _frame_header.unpack_from(buffer, offset)[0]
+            if offset + 2 + ln > end:
+                break
+            if ln:
+                packets.append(Packet(buffer[offset + 2], buffer[offset + 3:offset + 2 + ln]))
+            offset += 2 + ln
+        return packets, buffer[offset:]
+
+    from_frames = staticmethod(from_frames)
+
+
+#******************************************************************************
+class PacketReader:
+    """ Reassemble packets from a stream of received data.
+
+        The stream starts out as packet strings.  If a BINARY_HANDSHAKE line
+        turns up, everything after it is read as binary frames and the binary
+        attribute is set.  The packet server echoes the handshake back to a
+        client that sends it, so the same reader works at both ends of a
+        connection.
+        """
+
+    #--------------------------------------------------------------------------
+    def __init__(self):
+        self.binary = False
+        self.buffer = bytearray()
+
+
+    #--------------------------------------------------------------------------
+    def feed(self, data):
+        """ Add received data to the buffer and return a list of the packets
+            that are now complete.
+            """
+        self.buffer.extend(data)
+        packets = []
+        if not self.binary:
+            idx = self.buffer.find(BINARY_HANDSHAKE)
+            if idx < 0:
+                packets, self.buffer = Packet.from_lines(self.buffer)
+                return packets
+
+            packets, _ = Packet.from_lines(self.buffer[:idx])
+            del self.buffer[:idx + len(BINARY_HANDSHAKE)]
+            self.binary = True
+
+        frames, self.buffer = Packet.from_frames(self.buffer)
+        packets.extend(frames)
+        return packets
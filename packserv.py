@@ -10,6 +10,26 @@
 
     All of the serial port, listeing address, and listening port must be
     provided.
+
+    Packets are exchanged with clients as packet strings unless a client
+    sends the binary handshake (see packet.py), in which case that client
+    gets binary frames.  Both kinds of client can be connected at once.
+
+    A client can also send the server commands, as packets of type
+    packet.TYPE_CONTROL, which are not passed on to the serial port:
+
+        FILTER service=ID,... method=ID,... address=LOW-HIGH
+            Only send the client the tRPC packets that match, as well as
+            those that match its other filters (see trpc_msg.RouteFilter).
+            A client without filters is sent every packet.
+        CLEAR
+            Remove the client's filters.
+
+    Filters are matched against the header of each packet (see
+    trpc_msg.peek), through an index by method ID that is rebuilt whenever
+    the filters change, so the cost of matching depends on the number of
+    filters that name the packet's method rather than on the number of
+    clients.
     """
 
 
@@ -17,13 +37,14 @@
 import sys
 import os
 import datetime
+import time
 import serial
 import threading
 import socket
-import struct
 import tpck
 import select
 import packet
+import trpc_msg
 
 
 #******************************************************************************
@@ -33,6 +54,9 @@ TIMEOUT = 0.1
 # Number of bytes from the serial port to process at any given time.
 READ_SIZE = 100
 
+# Seconds between logs of the serial link statistics.
+STATS_INTERVAL = 300
+
 
 #******************************************************************************
 def message(msg):
@@ -83,6 +107,51 @@ class Connection:
         self.sock = sock
         self.addr = addr
 
+        # Reassembles packets from the data received from the socket and
+        # tracks whether the connection has switched to binary frames.
+        self.reader = packet.PacketReader()
+
+        # trpc_msg.RouteFilters set by the client.  Empty for every packet.
+        self.filters = []
+
+
+#******************************************************************************
+class FilterIndex:
+    """ Finds the connections that have a filter matching a packet.
+
+        Filters are grouped by the method IDs they name, so a packet is only
+        checked against the filters for its method and those that name no
+        method.
+        """
+
+    #--------------------------------------------------------------------------
+    def __init__(self, connections):
+        """ Build the index from the filters of a list of Connections.
+            """
+        self.by_method = {}
+        self.any_method = []
+        for c in connections:
+            for f in c.filters:
+                if f.methods is None:
+                    self.any_method.append((f, c))
+                else:
+                    for m in f.methods:
+                        self.by_method.setdefault(m, []).append((f, c))
+
+
+    #--------------------------------------------------------------------------
+    def match(self, route):
+        """ Return the set of connections with a filter that passes a packet,
+            given its routing information (see trpc_msg.peek).
+            """
+        serviceID, methodID, address = route
+        result = set()
+        for entries in (self.by_method.get(methodID, ()), self.any_method):
+            for f, c in entries:
+                if c not in result and f.match(serviceID, methodID, address):
+                    result.add(c)
+        return result
+
 
 #******************************************************************************
 class ConnectionList:
@@ -119,26 +188,71 @@ class RunSerial(threading.Thread):
         self.port = port
         self.connections = connect_list
         self.running = False
+        self.tpck_parser = tpck.TpckParser()
+
+        # Rebuilt from the connections' filters when they change.
+        self.filter_index = FilterIndex([])
+        self.filters_changed = False
 
 
     #--------------------------------------------------------------------------
-    def get_fmt(len_obj):
-        """ Return a format string (as required by struct methods) that can
-            be used to pack a list of or unpack a string of bytes.
+    def log_stats(self):
+        """ Log the tpck parser's counters for the serial link.
+            """
+        message('Serial link: %(frames_ok)d frames, '
+                '%(checksum_failures)d checksum failures, '
+                '%(resyncs)d resyncs, '
+                '%(discarded_bytes)d bytes discarded, '
+                '%(escape_anomalies)d escape anomalies.'
+                % self.tpck_parser.snapshot())
 
-            The length of the returned format string will be the length of the
-            len_obj argument.
+
+    #--------------------------------------------------------------------------
+    def control(self, c, p):
+        """ Carry out a command (see the module docs) sent by connection c as
+            packet p.
             """
-        return ''.join(['B'] * len(len_obj))
+        command = bytes(bytearray(p.data))
+        if not isinstance(command, str):
+            # Python 3:  bytes are not text.
+            command = command.decode('ascii', 'replace')
+        try:
+            if command.strip() == 'CLEAR':
+                c.filters = []
+            else:
+                c.filters.append(trpc_msg.RouteFilter.from_command(command))
+            self.filters_changed = True
+            message('%s:%d: %s' % (c.addr[0], c.addr[1], command))
+        except ValueError as e:
+            message('%s:%d: %s' % (c.addr[0], c.addr[1], e))
 
-    get_fmt = staticmethod(get_fmt)
+
+    #--------------------------------------------------------------------------
+    def route(self, pck_list):
+        """ Work out which of the packets each filtered connection is to be
+            sent.
+
+            Return a dictionary of lists of indexes in to pck_list, by
+            Connection.  Connections without filters are not included.
+            """
+        routes = {}
+        if not self.filter_index.by_method and not self.filter_index.any_method:
+            return routes
+        for i, p in enumerate(pck_list):
+            if p.type == packet.TYPE_TRPC:
+                route = trpc_msg.peek(p.data)
+                if route is not None:
+                    for c in self.filter_index.match(route):
+                        routes.setdefault(c, []).append(i)
+        return routes
 
 
     #--------------------------------------------------------------------------
     def run(self):
         """ Watch the serial port.
 
-            Send any received packets to all connected sockets.
+            Send any received packets to all connected sockets, or those
+            that match their filters.
             
             If any data is received from any of the connected sockets, convert
             that data to packets and send it to the serial port.
@@ -146,34 +260,49 @@ class RunSerial(threading.Thread):
             If any sockets die, remove them from the connection list.
             """
         self.running = True
-        tpck_state = None
+        stats_time = time.time() + STATS_INTERVAL
         try:
             while self.running:
                 # Read packets and store them in string form in send_data
-                byte_str = self.port.read(READ_SIZE)
-                fmt = RunSerial.get_fmt(byte_str)
-                bytes = list(struct.unpack(fmt, byte_str))
-                pck_list, tpck_state = tpck.parse(bytes, tpck_state)
-                send_data = ''.join([str(p) for p in pck_list])
+                pck_list = self.tpck_parser.feed(self.port.read(READ_SIZE))
+                pck_strs = [str(p) for p in pck_list]
+                send_data = ''.join(pck_strs)
+                send_frames = None
 
                 # Make a list of socket objects from the connection list.
                 self.connections.lock.acquire()
-                sock_list = [c.sock for c in self.connections.lst]
+                conn_from_sock = dict([(c.sock, c) for c in self.connections.lst])
                 self.connections.lock.release()
+                sock_list = list(conn_from_sock.keys())
 
                 # Removals is a list of dead or dying sockets.
                 removals = []
                 rl, wl, _ = select.select(sock_list, sock_list, [], TIMEOUT)
 
+                # Frames for the serial port from all of the clients, written
+                # in one go.
+                tx_frames = bytearray()
+
                 for r in rl:
                     try:
                         rx_str = r.recv(1024)
 
-                        # Read data, pack it, then send it.
-                        for s in [s for s in rx_str.rsplit('\n') if s]:
-                            pck_bytes = tpck.serialize(packet.Packet.from_str(s))
-                            fmt = RunSerial.get_fmt(pck_bytes)
-                            self.port.write(struct.pack(fmt, *pck_bytes))
+                        # Read data, pack it, then send it.  The reader keeps
+                        # any incomplete packet for the next read.
+                        c = conn_from_sock[r]
+                        binary = c.reader.binary
+                        rx_pcks = []
+                        for p in c.reader.feed(rx_str):
+                            if p.type == packet.TYPE_CONTROL:
+                                self.control(c, p)
+                            else:
+                                rx_pcks.append(p)
+                        if c.reader.binary and not binary:
+                            # Echo the handshake to mark where the frames
+                            # start in the data sent to the client.
+                            r.sendall(packet.BINARY_HANDSHAKE)
+                            message('Binary frames to %s:%d' % (c.addr[0], c.addr[1]))
+                        tpck.serialize_many(rx_pcks, tx_frames)
 
                     except socket.error:
                         # rx_str == '' should indicate that a socket closed.  It seems that
@@ -181,12 +310,50 @@ class RunSerial(threading.Thread):
                         # shows up in the readable list, but can't be read from.
                         removals.append(r)
 
+                if tx_frames:
+                    self.port.write(bytes(tx_frames))
+
+                # The filters sent with the data just read already apply to
+                # the packets about to be sent.
+                if self.filters_changed:
+                    self.filters_changed = False
+                    self.filter_index = FilterIndex(
+                            [c for c in conn_from_sock.values() if c.filters])
+
+                # Packets by filtered connection, and the data sent for each
+                # distinct selection of them.
+                routes = self.route(pck_list)
+                routed_data = {}
+
                 for w in wl:
                     # Write received data to connected sockets that are still
                     # alive.
                     if w not in removals:
                         try:
-                            w.send(send_data)
+                            c = conn_from_sock[w]
+                            if c.filters:
+                                selected = tuple(routes.get(c, ()))
+                                if selected:
+                                    key = (c.reader.binary, selected)
+                                    if key not in routed_data:
+                                        if c.reader.binary:
+                                            frames = bytearray()
+                                            for i in selected:
+                                                frames.extend(pck_list[i].to_frame())
+                                            routed_data[key] = frames
+                                        else:
+                                            routed_data[key] = ''.join([pck_strs[i] for i in selected])
+                                    w.sendall(routed_data[key])
+                            elif not c.reader.binary:
+                                w.send(send_data)
+                            elif pck_list:
+                                # A partial send would put the client out of
+                                # step with the frames, so send all of it.
+                                if send_frames is None:
+                                    send_frames = bytearray()
+                                    for p in pck_list:
+                                        send_frames.extend(p.to_frame())
+                                w.sendall(send_frames)
 
                         except socket.error:
                             removals.append(w)
@@ -198,8 +365,14 @@ class RunSerial(threading.Thread):
                     if s is not None:
                         close_socket(s)
                         self.connections.lst.remove(s)
+                        if s.filters:
+                            self.filters_changed = True
                 self.connections.lock.release()
 
+                if time.time() >= stats_time:
+                    self.log_stats()
+                    stats_time = time.time() + STATS_INTERVAL
+
         except:
             # Expected exception handling is buried in the calls within this
             # thread.  Anything else is to major to handle and is most likely
@@ -208,6 +381,7 @@ class RunSerial(threading.Thread):
         
         # Shut down the thread.  Wrap the port-close in a try block in case
         # we are here because the port got closed.
+        self.log_stats()
         message('Serial port closing.')
         try:
             self.port.close()
@@ -5,9 +5,10 @@
 
 #******************************************************************************
 import sys
-import struct
 import serial
 import threading
+import tpck
+import trpc_schema
 
 #******************************************************************************
 UINT8MAX = (2**8)-1
@@ -15,11 +16,6 @@ UINT16MAX = (2**16)-1
 UINT32MAX = (2**32)-1
 
 #******************************************************************************
-# TPCK Codes
-_SOF_CODE = 0xCA        # Start-of-frame
-_EOF_CODE = 0x35        # End-of-frame
-_ESC_CODE = 0x2F        # Escape (stuffing)
-
 # TPCK Types
 _TRPC_TYPE = 6          # tpck type - trpc
 
@@ -39,40 +35,12 @@ THA_NA_16 = 0xFFFF
 THA_NA_32 = 0xFFFFFFFF
 
 #******************************************************************************
-_stuff_list = (_SOF_CODE, _EOF_CODE, _ESC_CODE)
+# Services and methods, from the protocol schema (see trpc_schema.py).
+_schema = trpc_schema.load()
 
-#******************************************************************************
-trpc_services = {   0x00 : 'Update',
-                    0x01 : 'Request',
-                    0x02 : 'Report',
-                    0x03 : 'Response:Update',
-                    0x04 : 'Response:Request'
-                }
+trpc_services = dict(_schema['services'])
 
-#******************************************************************************
-trpc_methods = {    0x000 : 'NullMethod',
-                    0x107 : 'NetworkError',
-                    0x10F : 'ReportingState',
-                    0x117 : 'OutdoorTemp',
-                    0x11F : 'DeviceAttributes',
-                    0x127 : 'ModeSetting',
-                    0x12F : 'ActiveDemand',
-                    0x137 : 'CurrentTemp',
-                    0x13F : 'HeatSetpoint',
-                    0x147 : 'CoolSetpoint',
-                    0x14F : 'SlabSetpoint',
-                    0x157 : 'FanPercent',
-                    0x15F : 'TakingAddress',
-                    0x167 : 'DeviceInventory',
-                    0x16F : 'SetbackEnable',
-                    0x177 : 'SetbackState',
-                    0X17F : 'SetbackEvents',
-                    0x187 : 'FirmwareRevision',
-                    0x18F : 'ProtocolVersion',
-                    0x197 : 'DeviceType',
-                    0x19F : 'DeviceVersion',
-                    0x1A7 : 'DateTime'
-                }
+trpc_methods = dict([(m[0], m[1]) for m in _schema['methods']])
 
 #******************************************************************************
 # Find a key the has value = val
@@ -82,20 +50,7 @@ def find_key(dic, val):
 
 #******************************************************************************
 # List of methods that have the address attribute as the first data parameter
-address_support_list = (    find_key(trpc_methods, 'DeviceAttribues'),
-                            find_key(trpc_methods, 'ModeSetting'),
-                            find_key(trpc_methods, 'ActiveDemand'),
-                            find_key(trpc_methods, 'CurrentTemperature'),
-                            find_key(trpc_methods, 'HeatSetpoint'),
-                            find_key(trpc_methods, 'CoolSetpoint'),
-                            find_key(trpc_methods, 'SlabSetpoint'),
-                            find_key(trpc_methods, 'FanPercent'),
-                            find_key(trpc_methods, 'TakingAddress'),
-                            find_key(trpc_methods, 'SetbackState'),
-                            find_key(trpc_methods, 'SetbackEvents'),
-                            find_key(trpc_methods, 'DeiceType'),
-                            find_key(trpc_methods, 'DeviceVersion')
-                        )
+address_support_list = _schema['address_methods']
 
 #******************************************************************************
 # List of methods that have the setpoint attribute as data parameter after the
@@ -106,10 +61,6 @@ setpoint_support_list = (   find_key(trpc_methods, 'HeatSetpoint'),
                             find_key(trpc_methods, 'FanPercent')
                         )
 
-#******************************************************************************
-def _calc_checksum(type, data):
-    return sum(data, type + len(data)) & 0xFF
-
 #******************************************************************************
 def _pack_bytes(bytes, value):
     packed_data = []
@@ -143,82 +94,34 @@ class Tpck(object):
             Return the resulting sequence which will include start and end of
             frame delimiters along with escape characters and a checksum to
             validate the data.
+
+            The framing is done by the tpck module.
             """
-        def stuff_byte(b):
-            if b in _stuff_list:
-                build.append(_ESC_CODE)
-            build.append(b)
-
-        build = [_SOF_CODE]
-        stuff_byte(len(self.data))
-        stuff_byte(self.type)
-        for i in self.data:
-            stuff_byte(i)
-        stuff_byte(_calc_checksum(self.type, self.data))
-        build.append(_EOF_CODE)
-        return build
+        return list(tpck.serialize_into(self, bytearray()))
 
 #******************************************************************************
 class TpckStreamParser(object):
     """ Takes in a byte stream and returns a 
         list of packets have been received.
+
+        The framing is done by a tpck.TpckParser, so the demo and packserv
+        agree on what is a valid frame.
         """
     def __init__(self):
         self.reset()
                
     #--------------------------------------------------------------------------
     def reset(self):
-        self.idx = 0
-        self.length = 0
-        self.type = 0
-        self.data = []
-        self.cs = 0
-        self.escaped = False
+        self.parser = tpck.TpckParser()
 
     #--------------------------------------------------------------------------
     def tpck_from_stream(self, bytes):
-        """ create tpcks from a byte stream
+        """ create tpcks from a byte stream (a str, bytearray or list of byte
+            values)
             """
-        pck_list = []
-        for b in bytes:
-            complete = False
-            use_byte = True
-
-            if not self.escaped:
-                if b == _SOF_CODE:
-                    # Start of frame:  Reset the receiving state
-                    self.reset()
-                    use_byte = False
-                elif b == _ESC_CODE:
-                    # Escape:  Ignore the byte and prepare to accept the next one as data
-                    self.escaped = True
-                    use_byte = False
-                elif b == _EOF_CODE:
-                    # End of frame:  Ignore byte and flag completion.
-                    complete = True
-                    use_byte = False
-
-            if use_byte:
-                if self.idx == 0:
-                    # The 1st byte is the length
-                    self.length = b
-                elif self.idx == 1:
-                    # The 2nd byte is the type
-                    self.type = b
-                elif (self.idx > 1) and (self.idx < self.length+2):
-                    # The next "length" bytes are the data
-                    self.data.append(b)
-                elif self.idx == self.length+2:
-                    # And finally the checksum
-                    self.cs = b
-
-                self.idx += 1
-                self.escaped = False
-
-            if complete and (self.cs == _calc_checksum(self.type, self.data)):
-                pck_list.append(Tpck(self.type, self.data))
-        
-        return pck_list
+        if isinstance(bytes, list):
+            bytes = bytearray(bytes)
+        return [Tpck(p.type, list(p.data)) for p in self.parser.feed(bytes)]
 
 #******************************************************************************
 class Trpc(Tpck):
@@ -302,7 +205,7 @@ class Tha(Trpc):
     
     #--------------------------------------------------------------------------
     def __init__(self,  service=find_key(trpc_services, 'Request'),
-                        method=find_key(trpc_methods 'NullMethod'),
+                        method=find_key(trpc_methods, 'NullMethod'),
                         address=None,
                         error=None,
                         reporting_state=None,
@@ -429,18 +332,6 @@ class RunSerial(threading.Thread):
         self.rx_packets = []
         self.tx_packets = []
 
-    #--------------------------------------------------------------------------
-    def get_fmt(len_obj):
-        """ Return a format string (as required by struct methods) that can
-            be used to pack a list of or unpack a string of bytes.
-
-            The length of the returned format string will be the length of the
-            len_obj argument.
-            """
-        return ''.join(['B'] * len(len_obj))
-
-    get_fmt = staticmethod(get_fmt)
-
     #--------------------------------------------------------------------------
     def read(self):
         """ Pops the next rx packet from the queue
@@ -468,10 +359,7 @@ class RunSerial(threading.Thread):
         try:
             while self.running:
                 # Read in next byte
-                byte_str = self.port.read(READ_SIZE)
-                fmt = RunSerial.get_fmt(byte_str)
-                bytes = list(struct.unpack(fmt, byte_str))
-                pck_list = tpck_parser.tpck_from_stream(bytes)
+                pck_list = tpck_parser.tpck_from_stream(self.port.read(READ_SIZE))
                 # Put received packets into buffer
                 for p in pck_list:
                     tha_pck = Tha.from_tpck(p)
@@ -481,9 +369,7 @@ class RunSerial(threading.Thread):
                 # send the next packet out
                 if self.tx_packets != []:
                     tha_tx = self.tx_packets.pop(0)
-                    pck_bytes = tha_tx.serialize()
-                    fmt = RunSerial.get_fmt(pck_bytes)
-                    self.port.write(struct.pack(fmt, *pck_bytes))
+                    self.port.write(bytes(tpck.serialize_into(tha_tx, bytearray())))
 
         except:
             self.running = False
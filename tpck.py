@@ -5,10 +5,18 @@
     The tpck protocol provides data delimiting and validation for
     communication links that can not support the simplicity of the
     string-based packet transfer.
+
+    A frame is a start-of-frame code, then the data length, packet type,
+    data and checksum (with any of the three special codes escaped), then an
+    end-of-frame code.  The receiver is length-driven:  once a start-of-frame
+    code has been seen, the next length + 3 (un-escaped) bytes belong to the
+    frame whatever they are, and anything between the checksum and the
+    end-of-frame code is ignored.
     """
 
 
 #******************************************************************************
+import re
 import packet
 
 
@@ -21,6 +29,37 @@ _ESC_CODE = 0x2F        # Escape (stuffing)
 #******************************************************************************
 _stuff_list = (_SOF_CODE, _EOF_CODE, _ESC_CODE)
 
+# The codes as one-byte strings, for searching buffers.
+_SOF_STR = bytes(bytearray([_SOF_CODE]))
+_EOF_STR = bytes(bytearray([_EOF_CODE]))
+_ESC_STR = bytes(bytearray([_ESC_CODE]))
+
+# The codes that need stuffing, and a match for any of them.  None of the
+# codes are special in a regular expression.
+_stuff_codes = _SOF_STR + _EOF_STR + _ESC_STR
+_stuff_re = re.compile(b'[' + _stuff_codes + b']')
+
+# Escaping replacements, in order:  the escape code must be done first.
+_stuff_pairs = ((_ESC_STR, _ESC_STR + _ESC_STR),
+                (_SOF_STR, _ESC_STR + _SOF_STR),
+                (_EOF_STR, _ESC_STR + _EOF_STR))
+
+# An escaped escape code, and the other codes escaped.
+_ESC_ESC_STR = _ESC_STR + _ESC_STR
+_ESC_SOF_STR = _ESC_STR + _SOF_STR
+_ESC_EOF_STR = _ESC_STR + _EOF_STR
+
+# Matches stuffed bytes up to and including the first end-of-frame code that
+# is not escaped.  It is written as an unrolled loop, so that it never
+# backtracks, even when there is no end-of-frame code to find.
+_plain = b'[^' + _ESC_STR + _EOF_STR + b']*'
+_stuffed_re = re.compile(_plain + b'(?:' + _ESC_STR + b'.' + _plain + b')*' +
+        _EOF_STR, re.DOTALL)
+
+# Most stuffed bytes a frame's contents can take:  the length, type, data
+# and checksum, all escaped.
+_MAX_STUFFED = 2 * (255 + 3)
+
 
 #******************************************************************************
 def serialize(p):
@@ -46,6 +85,46 @@ def serialize(p):
     return build
 
 
+#******************************************************************************
+def serialize_into(p, buf):
+    """ Append the tpck frame for a packet object to a bytearray.
+
+        This produces the same bytes as serialize, but copies the frame
+        contents in whole and then escapes them with a replace per code (if
+        there is anything to escape) rather than a byte at a time.
+
+        Return buf.
+        """
+    start = len(buf) + 1
+    buf.append(_SOF_CODE)
+    buf.append(len(p.data))
+    buf.append(p.type)
+    buf.extend(p.data)
+    buf.append(_calc_checksum(p.type, p.data))
+    if _stuff_re.search(buf, start):
+        body = buf[start:]
+        for code, escaped in _stuff_pairs:
+            body = body.replace(code, escaped)
+        buf[start:] = body
+    buf.append(_EOF_CODE)
+    return buf
+
+
+#******************************************************************************
+def serialize_many(packets, buf=None):
+    """ Append the tpck frames for a sequence of packet objects to a
+        bytearray (a new one if buf is None), so that they can be written in
+        one go.
+
+        Return the bytearray.
+        """
+    if buf is None:
+        buf = bytearray()
+    for p in packets:
+        serialize_into(p, buf)
+    return buf
+
+
 #******************************************************************************
 def parse(bytes, state=None):
     """ From a stream of bytes, parse out packets using the tpck protocol.
@@ -61,20 +140,18 @@ def parse(bytes, state=None):
             state_obj = None
             while True:
                 bytes = stream_obj.read()
-                packet_list = tpck.parse(bytes, state_obj)
+                packet_list, state_obj = tpck.parse(bytes, state_obj)
                 for p in packet_list:
                     print p
+
+        The bytes can be a str, bytearray or a list of byte values.  The
+        state object is a TpckParser.
         """
-    packets = []
     if state is None:
-        state = _TpckRxState()
-    try:
-        while True:
-            if state.feed(bytes.pop(0)):
-                packets.append(packet.Packet(state.type, state.data))
-                state.reset()
-    except IndexError:
-        return packets, state
+        state = TpckParser()
+    if isinstance(bytes, list):
+        bytes = bytearray(bytes)
+    return state.feed(bytes), state
 
 
 #******************************************************************************
@@ -82,10 +159,303 @@ def _calc_checksum(type, data):
     return sum(data, type + len(data)) & 0xFF
 
 
+#******************************************************************************
+def _unstuff(buf, pos, n):
+    """ Read n bytes from buf, starting at pos, dropping the escape code in
+        front of any escaped byte.  Each escape code found pushes the end of
+        the bytes out by one, so the escapes are walked with find and the
+        pieces between them copied out in one join.  This is only needed for
+        malformed frames; see _unstuff_all.
+
+        Return the bytes (as a bytearray), the position following them and
+        the number of escape codes in front of a byte that does not need
+        escaping as a tuple, or None if buf ends first.
+        """
+    end = pos + n
+    size = len(buf)
+    if end > size:
+        return None
+    find = buf.find
+    esc = find(_ESC_STR, pos, end)
+    if esc < 0:
+        # Nothing escaped:  the usual case.
+        return buf[pos:end], end, 0
+
+    pieces = []
+    append = pieces.append
+    anomalies = 0
+    while esc >= 0:
+        end += 1
+        if end > size:
+            return None
+        if buf[esc + 1] not in _stuff_list:
+            anomalies += 1
+        append(buf[pos:esc])
+        pos = esc + 1
+        esc = find(_ESC_STR, esc + 2, end)
+    append(buf[pos:end])
+    return bytearray().join(pieces), end, anomalies
+
+
+#******************************************************************************
+def _unstuff_all(stuffed):
+    """ Drop the escape codes from stuffed bytes (a bytearray) that end on a
+        whole escaped byte, with a few byte string methods rather than by
+        stepping through the escapes.
+
+        replace works from the left, so it pairs up each run of escape codes
+        as the receiver does.  With the escaped escape codes taken out, every
+        escape code left escapes the byte after it, which gives the counts.
+        Then, unless an escape code is in front of some other byte, taking
+        the escape code off each escaped start or end-of-frame code and then
+        halving the runs of escape codes leaves floor(k / 2) of a run of k,
+        which is what unstuffing leaves.
+
+        Return the bytes (as a bytearray), the number of escaped
+        start-of-frame codes and the number of escape codes in front of a
+        byte that does not need escaping as a tuple.
+        """
+    single = stuffed.replace(_ESC_ESC_STR, b'')
+    count = single.count
+    escaped_sof = count(_ESC_SOF_STR)
+    anomalies = count(_ESC_STR) - escaped_sof - count(_ESC_EOF_STR)
+    if len(single) == len(stuffed):
+        data = stuffed.replace(_ESC_STR, b'')
+    elif not anomalies:
+        data = stuffed.replace(_ESC_SOF_STR, _SOF_STR).replace(
+                _ESC_EOF_STR, _EOF_STR).replace(_ESC_ESC_STR, _ESC_STR)
+    else:
+        data = bytearray(_ESC_STR).join([c.replace(_ESC_STR, b'')
+                for c in stuffed.split(_ESC_ESC_STR)])
+    return data, escaped_sof, anomalies
+
+
+#******************************************************************************
+def _find_unescaped(buf, code, pos, end):
+    """ Return the position of the first code (a one-byte string) in
+        buf[pos:end] that is not an escaped byte, or -1 if there is none.
+        Escapes are paired up from pos, so a code is escaped if an odd number
+        of escape codes runs up to it.
+        """
+    idx = buf.find(code, pos, end)
+    while idx >= 0:
+        run = idx
+        while run > pos and buf[run - 1] == _ESC_CODE:
+            run -= 1
+        if (idx - run) % 2 == 0:
+            return idx
+        idx = buf.find(code, idx + 1, end)
+    return -1
+
+
+#******************************************************************************
+# TpckParser states
+_HUNT = 0       # Waiting for a start-of-frame code
+_FRAME = 1      # Waiting for the length, type, data and checksum
+_TRAIL = 2      # Waiting for the end-of-frame code
+
+
+#******************************************************************************
+class TpckParser:
+    """ Receiver for the tpck protocol.
+
+        Rather than stepping through the stream a byte at a time, the parser
+        searches each chunk for the start and end-of-frame codes and copies
+        out the frame contents a slice at a time.  A frame with escape codes
+        in it is matched up to its end-of-frame code and unstuffed in bulk
+        (see _unstuff_all); only a frame whose end-of-frame code does not
+        follow the checksum is read by its length, walking the escapes.  The
+        framing is the same as that of _TpckRxState.
+
+        Bytes that may still be needed (an incomplete frame) are kept between
+        calls to feed.
+
+        The parser also counts what it sees, for judging the health of the
+        link (see snapshot):
+            frames_ok           Frames that passed the checksum.
+            checksum_failures   Frames that failed the checksum.
+            resyncs             Failed frames with an unescaped start-of-frame
+                                code inside them, where the sender most
+                                likely started again part way through.
+            discarded_bytes     Bytes skipped outside of frames, before a
+                                start-of-frame or end-of-frame code.
+            escape_anomalies    Escape codes in front of a byte that never
+                                needs escaping.
+            lengths             Number of frames (good or bad) of each data
+                                length, indexed by length.
+        """
+
+    #--------------------------------------------------------------------------
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = _HUNT
+        self.type = 0
+        self.data = bytearray()
+        self.cs = 0
+        self.resync = False
+        self.frames_ok = 0
+        self.checksum_failures = 0
+        self.resyncs = 0
+        self.discarded_bytes = 0
+        self.escape_anomalies = 0
+        self.lengths = [0] * 256
+
+
+    #--------------------------------------------------------------------------
+    def feed(self, chunk):
+        """ Parse a chunk of the stream (str, bytearray, ...) and return a
+            list of the valid packets that it completes.
+            """
+        buf = self.buffer
+        buf.extend(chunk)
+        find = buf.find
+        size = len(buf)
+        packets = []
+        Packet = packet.Packet
+        lengths = self.lengths
+        discarded = 0
+        pos = 0
+        state = self.state
+        while True:
+            if state == _HUNT:
+                idx = find(_SOF_STR, pos)
+                if idx < 0:
+                    discarded += size - pos
+                    pos = size
+                    break
+                discarded += idx - pos
+                pos = idx + 1
+
+                # Fast path:  a whole frame with nothing escaped and the
+                # end-of-frame code straight after the checksum.
+                if pos < size:
+                    length = buf[pos]
+                    end = pos + length + 3
+                    if (end < size and buf[end] == _EOF_CODE and
+                            find(_ESC_STR, pos, end) < 0):
+                        lengths[length] += 1
+                        type = buf[pos + 1]
+                        data = buf[pos + 2:end - 1]
+                        if sum(data, type + length) & 0xFF == buf[end - 1]:
+                            packets.append(Packet(type, data))
+                        else:
+                            # Nothing is escaped, so any start-of-frame
+                            # code is a real one.
+                            self.failed(find(_SOF_STR, pos, end) >= 0)
+                        pos = end + 1
+                        continue
+                state = _FRAME
+
+            # A frame found by the hunt is read straight away.
+            if state == _FRAME:
+                # The frame is only consumed once all of it is here.  Until
+                # then, pos stays at its start.
+                if size - pos < 3 or (buf[pos] != _ESC_CODE and
+                        pos + buf[pos] + 3 > size):
+                    # Too short even if nothing in it is escaped.
+                    break
+
+                # When the end-of-frame code follows the checksum, as it
+                # nearly always does, the frame runs up to the first
+                # unescaped one, and is unstuffed in one go.
+                match = _stuffed_re.match(buf, pos, pos + _MAX_STUFFED + 1)
+                if match is not None:
+                    end = match.end() - 1
+                    data, escaped_sof, anomalies = _unstuff_all(buf[pos:end])
+                    length = len(data) - 3
+                    if length >= 0 and data[0] == length:
+                        self.escape_anomalies += anomalies
+                        lengths[length] += 1
+                        type = data[1]
+                        cs = data.pop()
+                        del data[:2]
+                        if sum(data, type + length) & 0xFF == cs:
+                            packets.append(Packet(type, data))
+                        else:
+                            # Only a start-of-frame code that was not
+                            # escaped is a resync.
+                            self.failed(buf.count(_SOF_STR, pos, end) >
+                                    escaped_sof)
+                        pos = end + 1
+                        state = _HUNT
+                        continue
+
+                # Otherwise read it by its length, and hunt for the
+                # end-of-frame code after it.
+                head = _unstuff(buf, pos, 2)
+                if head is None:
+                    break
+                body = _unstuff(buf, head[1], head[0][0] + 1)
+                if body is None:
+                    break
+                data, end, anomalies = body
+                type = head[0][1]
+                cs = data.pop()
+                resync = _find_unescaped(buf, _SOF_STR, pos, end) >= 0
+                self.escape_anomalies += head[2] + anomalies
+                lengths[head[0][0]] += 1
+                self.data = data
+                self.type = type
+                self.cs = cs
+                self.resync = resync
+                pos = end
+                state = _TRAIL
+
+            else:
+                idx = find(_EOF_STR, pos)
+                if idx < 0:
+                    self.resync = (self.resync or
+                            _find_unescaped(buf, _SOF_STR, pos, size) >= 0)
+                    discarded += size - pos
+                    pos = size
+                    break
+                self.resync = (self.resync or
+                            _find_unescaped(buf, _SOF_STR, pos, idx) >= 0)
+                discarded += idx - pos
+                pos = idx + 1
+                state = _HUNT
+                if _calc_checksum(self.type, self.data) == self.cs:
+                    packets.append(Packet(self.type, self.data))
+                else:
+                    self.failed(self.resync)
+
+        del buf[:pos]
+        self.state = state
+        self.frames_ok += len(packets)
+        self.discarded_bytes += discarded
+        return packets
+
+
+    #--------------------------------------------------------------------------
+    def failed(self, resync):
+        """ Count a frame that failed its checksum.
+            """
+        self.checksum_failures += 1
+        if resync:
+            self.resyncs += 1
+
+
+    #--------------------------------------------------------------------------
+    def snapshot(self):
+        """ Return the counters as a dictionary (with a copy of the length
+            histogram), so that they can be logged or compared with a later
+            snapshot.
+            """
+        return {'frames_ok': self.frames_ok,
+                'checksum_failures': self.checksum_failures,
+                'resyncs': self.resyncs,
+                'discarded_bytes': self.discarded_bytes,
+                'escape_anomalies': self.escape_anomalies,
+                'lengths': list(self.lengths)}
+
+
 #******************************************************************************
 class _TpckRxState:
     """ Receiver state object implemented by generator functions (similar to
         protothreads.
+
+        This has been replaced by TpckParser, but is kept as the reference
+        for the framing behaviour.
         """
 
     #--------------------------------------------------------------------------
@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+
+""" Conformance and speed harness for the tpck engine.
+
+    The same byte streams are fed to the tpck engine (as used by both
+    packserv and tha_demo) and to the legacy receivers it replaced, and the
+    packets that come out are compared.  The throughput of each receiver and
+    serializer is reported in MB/s.
+
+    Example command line usage:
+        python tpck_conform.py [CAPTURE_FILE ...]
+
+    Each capture file is a raw recording of the bytes on a serial link, and
+    is checked along with the generated streams (clean, heavily stuffed,
+    noisy, truncated and random bytes).
+
+    The legacy tpck receiver and the engine must agree on every stream.  The
+    legacy tha_demo receiver is end-of-frame driven rather than length
+    driven, so it only has to agree on streams without errors; elsewhere the
+    number of differences is just reported.
+
+    The header-only routing of trpc_msg.peek and peek_line is also checked
+    against full decoding.
+    """
+
+
+#******************************************************************************
+import sys
+import time
+import random
+import struct
+import difflib
+import tpck
+import packet
+import tha_demo
+import trpc_msg
+
+
+#******************************************************************************
+# Number of packets in each generated stream.
+STREAM_PACKETS = 5000
+
+# Largest chunk fed to a receiver at once.
+CHUNK_SIZE = 1024
+
+# Size of the serial port reads of packserv and tha_demo.  The tpck
+# receivers are also timed on streams read this much at a time.
+READ_SIZE = 100
+
+_SOF_CODE = 0xCA
+_EOF_CODE = 0x35
+_ESC_CODE = 0x2F
+_special = (_SOF_CODE, _EOF_CODE, _ESC_CODE)
+
+
+#******************************************************************************
+class _LegacyThaParser(object):
+    """ The tha_demo receiver before it used the tpck engine, frozen here as
+        the reference.
+        """
+    def __init__(self):
+        self.reset()
+
+    #--------------------------------------------------------------------------
+    def reset(self):
+        self.idx = 0
+        self.length = 0
+        self.type = 0
+        self.data = []
+        self.cs = 0
+        self.escaped = False
+
+    #--------------------------------------------------------------------------
+    def tpck_from_stream(self, bytes):
+        pck_list = []
+        for b in bytes:
+            complete = False
+            use_byte = True
+
+            if not self.escaped:
+                if b == _SOF_CODE:
+                    self.reset()
+                    use_byte = False
+                elif b == _ESC_CODE:
+                    self.escaped = True
+                    use_byte = False
+                elif b == _EOF_CODE:
+                    complete = True
+                    use_byte = False
+
+            if use_byte:
+                if self.idx == 0:
+                    self.length = b
+                elif self.idx == 1:
+                    self.type = b
+                elif (self.idx > 1) and (self.idx < self.length+2):
+                    self.data.append(b)
+                elif self.idx == self.length+2:
+                    self.cs = b
+
+                self.idx += 1
+                self.escaped = False
+
+            if complete and (self.cs == tpck._calc_checksum(self.type, self.data)):
+                pck_list.append(tha_demo.Tpck(self.type, self.data))
+
+        return pck_list
+
+
+#******************************************************************************
+def run_legacy_tpck(chunks):
+    """ Receive with tpck's legacy generator receiver, as tpck.parse used to,
+        from the unpacked serial read onwards.
+        """
+    packets = []
+    state = tpck._TpckRxState()
+    for c in chunks:
+        bytes = list(struct.unpack('%dB' % len(c), c))
+        try:
+            while True:
+                if state.feed(bytes.pop(0)):
+                    packets.append(packet.Packet(state.type, state.data))
+                    state.reset()
+        except IndexError:
+            pass
+    return packets
+
+
+#******************************************************************************
+def run_tpck(chunks):
+    """ Receive with the tpck engine.
+        """
+    packets = []
+    parser = tpck.TpckParser()
+    for c in chunks:
+        packets.extend(parser.feed(c))
+    return packets
+
+
+#******************************************************************************
+def run_legacy_tha(chunks):
+    """ Receive with the legacy tha_demo receiver.
+        """
+    packets = []
+    parser = _LegacyThaParser()
+    for c in chunks:
+        packets.extend(parser.tpck_from_stream(list(struct.unpack('%dB' % len(c), c))))
+    return packets
+
+
+#******************************************************************************
+def run_tha(chunks):
+    """ Receive with tha_demo's receiver.
+        """
+    packets = []
+    parser = tha_demo.TpckStreamParser()
+    for c in chunks:
+        packets.extend(parser.tpck_from_stream(c))
+    return packets
+
+
+#******************************************************************************
+receivers = (   ('legacy tpck', run_legacy_tpck),
+                ('tpck', run_tpck),
+                ('legacy tha_demo', run_legacy_tha),
+                ('tha_demo', run_tha)
+            )
+
+
+#******************************************************************************
+def random_packets(rand, count, stuffed=False):
+    """ Return a list of count random packets.  Stuffed packets are mostly
+        made of the special codes.
+        """
+    def byte():
+        if stuffed and rand.random() < 0.5:
+            return rand.choice(_special)
+        return rand.randint(0, 255)
+
+    return [packet.Packet(byte(), [byte() for i in range(rand.randint(0, 40))])
+            for n in range(count)]
+
+
+#******************************************************************************
+def frame_stream(packets):
+    """ Return the legacy serialization of a list of packets as a list of
+        frames (each a bytearray).
+        """
+    return [bytearray(tpck.serialize(p)) for p in packets]
+
+
+#******************************************************************************
+def add_noise(rand, frames):
+    """ Insert, drop and corrupt bytes in about one frame in five, and put
+        junk between some frames.
+        """
+    for f in frames:
+        if rand.random() < 0.2:
+            for i in range(rand.randint(1, 3)):
+                pos = rand.randrange(len(f))
+                action = rand.randint(0, 2)
+                if action == 0:
+                    f.insert(pos, rand.choice(_special + (rand.randint(0, 255),)))
+                elif action == 1 and len(f) > 1:
+                    del f[pos]
+                else:
+                    f[pos] ^= 1 << rand.randint(0, 7)
+        if rand.random() < 0.05:
+            f.extend(bytearray(rand.randint(0, 255) for i in range(rand.randint(1, 8))))
+    return frames
+
+
+#******************************************************************************
+def truncate(rand, frames):
+    """ Cut about one frame in five short.
+        """
+    for f in frames:
+        if rand.random() < 0.2:
+            del f[rand.randint(1, len(f) - 1):]
+    return frames
+
+
+#******************************************************************************
+def streams(rand, capture_names):
+    """ Return a list of (name, data, clean) tuples to check.  The data is a
+        str, and clean is True when the stream has no errors in it.
+        """
+    join = lambda frames: bytes(bytearray().join(frames))
+    result = [
+            ('clean', join(frame_stream(random_packets(rand, STREAM_PACKETS))), True),
+            ('stuffed', join(frame_stream(random_packets(rand, STREAM_PACKETS, True))), True),
+            ('noisy', join(add_noise(rand, frame_stream(random_packets(rand, STREAM_PACKETS)))), False),
+            ('truncated', join(truncate(rand, frame_stream(random_packets(rand, STREAM_PACKETS)))), False),
+            ('random', bytes(bytearray(rand.randint(0, 255) for i in range(100000))), False)]
+    for name in capture_names:
+        f = open(name, 'rb')
+        result.append((name, f.read(), False))
+        f.close()
+    return result
+
+
+#******************************************************************************
+def chunk(rand, data):
+    """ Split data into chunks of random size.
+        """
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rand.randint(1, CHUNK_SIZE)
+        chunks.append(data[pos:pos + size])
+        pos += size
+    return chunks
+
+
+#******************************************************************************
+def differences(a, b):
+    """ Return the number of packets in either list (of two) that are not
+        matched by a packet in the other, in order.  The lists are aligned
+        on their longest matching runs, so that one extra or missing packet
+        counts once rather than shifting the rest, while packets that come
+        out in a different order count as differences.
+        """
+    keys_a = [(p.type, bytes(bytearray(p.data))) for p in a]
+    keys_b = [(p.type, bytes(bytearray(p.data))) for p in b]
+    if keys_a == keys_b:
+        return 0
+    matcher = difflib.SequenceMatcher(None, keys_a, keys_b, autojunk=False)
+    matched = sum([block[2] for block in matcher.get_matching_blocks()])
+    return len(keys_a) + len(keys_b) - 2 * matched
+
+
+#******************************************************************************
+def timed(func, *args):
+    """ Call func with args and return the result and the time taken.
+        """
+    start = time.time()
+    result = func(*args)
+    return result, max(time.time() - start, 1e-9)
+
+
+#******************************************************************************
+def check_streams(rand, capture_names):
+    """ Check the receivers against each other on every stream, and report
+        their throughput.  Return the number of failures.
+        """
+    failures = 0
+    for name, data, clean in streams(rand, capture_names):
+        chunks = chunk(rand, data)
+        results = {}
+        times = {}
+        rates = []
+        for rx_name, rx in receivers:
+            results[rx_name], times[rx_name] = timed(rx, chunks)
+            rates.append('%s %.2f' % (rx_name, len(data) / times[rx_name] / 1e6))
+
+        reads = [data[i:i + READ_SIZE] for i in range(0, len(data), READ_SIZE)]
+        legacy_reads, t_legacy = timed(run_legacy_tpck, reads)
+        tpck_reads, t_tpck = timed(run_tpck, reads)
+
+        print '%s: %d bytes, %d packets' % (name, len(data), len(results['tpck']))
+        print '    MB/s: %s' % ', '.join(rates)
+        print '    tpck over legacy tpck: %.1fx, %.1fx (%.2f MB/s) in %d-byte reads' % (
+                times['legacy tpck'] / times['tpck'], t_legacy / t_tpck,
+                len(data) / t_tpck / 1e6, READ_SIZE)
+
+        diff = (differences(results['legacy tpck'], results['tpck']) +
+                differences(legacy_reads, tpck_reads))
+        if diff:
+            print '    FAIL: tpck differs from legacy tpck in %d packets' % diff
+            failures += 1
+
+        diff = differences(results['legacy tha_demo'], results['tha_demo'])
+        if diff and clean:
+            print '    FAIL: tha_demo differs from legacy tha_demo in %d packets' % diff
+            failures += 1
+        elif diff:
+            print '    tha_demo differs from legacy tha_demo in %d packets' % diff
+    return failures
+
+
+#******************************************************************************
+def check_serialize(rand):
+    """ Check the serializers against the legacy one, and report their
+        throughput.  Return the number of failures.
+        """
+    failures = 0
+    for name, stuffed in (('clean', False), ('stuffed', True)):
+        packets = random_packets(rand, STREAM_PACKETS, stuffed)
+        legacy, t_legacy = timed(frame_stream, packets)
+        legacy = bytearray().join(legacy)
+        many, t_many = timed(tpck.serialize_many, packets)
+        tha = [tha_demo.Tpck(p.type, p.data) for p in packets]
+        tha, t_tha = timed(lambda: [x.serialize() for x in tha])
+        tha = bytearray().join([bytearray(x) for x in tha])
+
+        print 'serialize %s: %d bytes' % (name, len(legacy))
+        print '    MB/s: legacy %.2f, serialize_many %.2f, tha_demo %.2f' % (
+                len(legacy) / t_legacy / 1e6, len(legacy) / t_many / 1e6,
+                len(legacy) / t_tha / 1e6)
+        if many != legacy:
+            print '    FAIL: serialize_many differs from legacy serialize'
+            failures += 1
+        if tha != legacy:
+            print '    FAIL: tha_demo serialize differs from legacy serialize'
+            failures += 1
+    return failures
+
+
+#******************************************************************************
+def check_counters():
+    """ Check the health counters of the tpck engine on frames with a known
+        outcome.  Return the number of failures.
+        """
+    def corrupt(data, change):
+        frame = bytearray(tpck.serialize(packet.Packet(6, data)))
+        change(frame)
+        return bytes(frame)
+
+    def bad_checksum(frame):
+        frame[-2] ^= 0x40
+
+    def restart(frame):
+        # The sender starts again after the type, with a fresh frame.
+        frame[3:3] = bytearray(tpck.serialize(packet.Packet(6, [1])))
+
+    cases = (
+            # An escaped start-of-frame code in a bad frame is not a resync.
+            ('escaped SOF', corrupt([0xCA, 1, 2], bad_checksum),
+                    {'checksum_failures': 1, 'resyncs': 0}),
+            ('escaped ESC then SOF', corrupt([0x2F, 0xCA], bad_checksum),
+                    {'checksum_failures': 1, 'resyncs': 0}),
+            ('restart', corrupt([1, 2, 3], restart),
+                    {'checksum_failures': 1, 'resyncs': 1}),
+            ('anomaly', corrupt([1, 2], lambda f: f.insert(3, 0x2F)),
+                    {'frames_ok': 1, 'escape_anomalies': 1}))
+
+    failures = 0
+    for name, data, expected in cases:
+        for size in (len(data), 1):
+            parser = tpck.TpckParser()
+            for i in range(0, len(data), size):
+                parser.feed(data[i:i + size])
+            counters = parser.snapshot()
+            wrong = [(k, counters[k]) for k in sorted(expected)
+                    if counters[k] != expected[k]]
+            if wrong:
+                print 'FAIL: counters for %s, fed %d bytes at a time: %r' % (
+                        name, size, wrong)
+                failures += 1
+    return failures
+
+
+#******************************************************************************
+def check_peek():
+    """ Check trpc_msg.peek and peek_line against full decoding, for every
+        service and method, with packet strings as str and bytearray.
+        Return the number of failures.
+        """
+    failures = 0
+    for service in sorted(trpc_msg.serviceID_from_name.values()):
+        for method in sorted(trpc_msg.methodID_from_name.values()):
+            p = trpc_msg.TrpcPacket.build(service, method, address=1001).to_tpck()
+            trpc = trpc_msg.TrpcPacket.from_packet(p)
+            address = None
+            if method in trpc_msg.address_methods:
+                address = trpc.body['address']
+            expected = (trpc.header['serviceID'], trpc.header['methodID'], address)
+            line = str(p)
+            for name, got in (('peek', trpc_msg.peek(p.data)),
+                    ('peek_line', trpc_msg.peek_line(line)),
+                    ('peek_line of a bytearray',
+                            trpc_msg.peek_line(bytearray(line)))):
+                if got != expected:
+                    print 'FAIL: %s of %s gave %r, not %r' % (
+                            name, line.strip(), got, expected)
+                    failures += 1
+
+    # Lines that are not tRPC packets, or too short for a header.
+    for line in ('', '06', '0601', '01013F01\n', '06013G01\n', '06013F0\n'):
+        for got in (trpc_msg.peek_line(line),
+                trpc_msg.peek_line(bytearray(line))):
+            if got is not None:
+                print 'FAIL: peek_line of %r gave %r, not None' % (line, got)
+                failures += 1
+    return failures
+
+
+#******************************************************************************
+if __name__ == '__main__':
+    rand = random.Random(1)
+    failures = (check_streams(rand, sys.argv[1:]) + check_serialize(rand) +
+            check_counters() + check_peek())
+    if failures:
+        print '%d failures.' % failures
+        sys.exit(1)
+    print 'All checks passed.'
@@ -0,0 +1,302 @@
+#!/usr/bin/env python3
+
+""" asyncio client for the packet server (Python 3 only).
+
+    AsyncTrpcSocket is the asyncio counterpart of trpc_sock.TrpcSocket:
+    TrpcPackets are read and written the same way (as packet strings or
+    binary frames), but every wait is a coroutine, so a single event loop can
+    drive any number of packet server connections alongside other work.
+
+    Example usage:
+        import asyncio
+        import trpc_async
+        import trpc_msg
+
+        async def monitor(addr, port):
+            sock = trpc_async.AsyncTrpcSocket(addr, port)
+            if await sock.open():
+                await sock.write(trpc_msg.TrpcPacket.build('Request',
+                        'HeatSetpoint', address=1001))
+                async for p in sock:
+                    print(p)
+                await sock.close()
+
+        async def main():
+            await asyncio.gather(*[monitor(a, p) for a, p in servers])
+
+        asyncio.run(main())
+    """
+
+
+#******************************************************************************
+import asyncio
+import collections
+
+import packet
+import trpc_msg
+import trpc_sock
+
+from get_trpc_host import get_trpc_host
+
+
+#******************************************************************************
+class AsyncTrpcSocket:
+
+    #**************************************************************************
+    def __init__(self, addr=None, port=None, binary=False, pool=None):
+        """ Create the socket object.  The arguments are the same as for
+            trpc_sock.TrpcSocket.
+            """
+        if addr is None or port is None:
+            a, p = get_trpc_host()
+            if addr is None:
+                addr = a
+            if port is None:
+                port = p
+
+        self.stream_reader = None
+        self.stream_writer = None
+        self.is_open = False
+        self.addr = addr
+        self.port = port
+        self.binary = binary
+        self.pool = pool
+        self.reader = None
+        self.rx_queue = collections.deque()
+
+
+    #**************************************************************************
+    async def open(self):
+        """ Connect to the packet server.
+
+            Return True if successful, False if not.
+            """
+        try:
+            self.stream_reader, self.stream_writer = await asyncio.open_connection(
+                    self.addr, self.port)
+        except OSError:
+            self.stream_reader = self.stream_writer = None
+            self.is_open = False
+            return False
+
+        self.reader = trpc_sock.TrpcReader(self.binary, self.pool)
+        self.rx_queue.clear()
+        if self.binary:
+            # The server echoes the handshake back and the reader switches to
+            # binary frames when it sees it.
+            self.stream_writer.write(packet.BINARY_HANDSHAKE)
+        self.is_open = True
+        return True
+
+
+    #**************************************************************************
+    async def close(self):
+        """ Close the connection.
+            """
+        if self.stream_writer is not None:
+            writer = self.stream_writer
+            self.stream_reader = self.stream_writer = None
+            self.is_open = False
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+    #**************************************************************************
+    def __aiter__(self):
+        """ Iterate over the packets received until the connection is closed,
+            e.g.
+                async for p in sock:
+                    print(p)
+            """
+        return self
+
+
+    #**************************************************************************
+    async def __anext__(self):
+        p = await self.read()
+        if p is None:
+            raise StopAsyncIteration
+        return p
+
+
+    #**************************************************************************
+    async def read(self, timeout=None):
+        """ Read a packet, waiting for one to arrive if none has been queued.
+            Unlike TrpcSocket.read, this waits for as long as it takes by
+            default, since awaiting it holds up nothing else.  Otherwise
+            timeout is as for TrpcSocket.read, except that a timeout of 0
+            only returns a packet that is already queued.
+
+            Return a TrpcPacket object, or None if the time ran out or the
+            connection is closed.
+            """
+        if await self.wait(timeout):
+            return self.rx_queue.popleft()
+        return None
+
+
+    #**************************************************************************
+    async def read_many(self, max_count=None, timeout=None):
+        """ Read every packet that is complete, or at most max_count of them.
+            If no packet has been queued, wait for one as read does.
+
+            Return a list of TrpcPacket objects, which is empty if the time
+            ran out or the connection is closed.
+            """
+        packets = []
+        if await self.wait(timeout):
+            queue = self.rx_queue
+            if max_count is None or max_count >= len(queue):
+                packets.extend(queue)
+                queue.clear()
+            else:
+                for i in range(max_count):
+                    packets.append(queue.popleft())
+        return packets
+
+
+    #**************************************************************************
+    async def wait(self, timeout=None):
+        """ Wait until a packet has been queued, the connection is closed, or
+            timeout seconds have passed.  If the server closes the connection,
+            or the connection fails, the socket is closed.
+
+            Return True if a packet is queued.
+            """
+        loop = asyncio.get_running_loop()
+        if timeout is not None:
+            deadline = loop.time() + timeout
+
+        while not self.rx_queue and self.stream_reader is not None:
+            read = self.stream_reader.read(trpc_sock.RECV_SIZE)
+            try:
+                if timeout is None:
+                    data = await read
+                else:
+                    data = await asyncio.wait_for(read,
+                            max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                break
+            except OSError:
+                data = b''
+
+            if data:
+                self.rx_queue.extend(self.reader.feed(data))
+            else:
+                await self.close()
+
+        return len(self.rx_queue) != 0
+
+
+    #**************************************************************************
+    async def write(self, trpc_packet):
+        """ Write a TrpcPacket object, waiting while the connection is too
+            far behind.
+            """
+        if self.stream_writer is not None:
+            self.stream_writer.write(trpc_sock.encode(trpc_packet, self.binary))
+            await self.stream_writer.drain()
+
+
+    #**************************************************************************
+    async def add_filter(self, services=None, methods=None, addresses=None):
+        """ Ask the packet server to send only the tRPC packets that match a
+            filter.  See TrpcSocket.add_filter.
+            """
+        await self.control(trpc_msg.RouteFilter(services, methods,
+                addresses).to_command())
+
+
+    #**************************************************************************
+    async def clear_filters(self):
+        """ Remove the filters.  See TrpcSocket.clear_filters.
+            """
+        await self.control('CLEAR')
+
+
+    #**************************************************************************
+    async def control(self, command):
+        """ Send a command to the packet server (see packserv.py).
+            """
+        if self.stream_writer is not None:
+            p = packet.Packet(packet.TYPE_CONTROL, bytearray(command.encode('ascii')))
+            self.stream_writer.write(trpc_sock.encode_packet(p, self.binary))
+            await self.stream_writer.drain()
+
+
+    #**************************************************************************
+    async def write_many(self, trpc_packets):
+        """ Write a sequence of TrpcPacket objects in one go.
+            """
+        if self.stream_writer is not None:
+            self.stream_writer.write(b''.join([trpc_sock.encode(p, self.binary)
+                    for p in trpc_packets]))
+            await self.stream_writer.drain()
+
+
+#******************************************************************************
+async def check():
+    """ Round-trip packets made by the TrpcPacket constructor and by
+        TrpcPacket.build through an echo server, as packet strings and as
+        binary frames.  An echo server acts as a packet server would here,
+        since it also echoes the binary handshake back.
+
+        Return the number of failures.
+        """
+    async def echo(reader, writer):
+        while True:
+            data = await reader.read(trpc_sock.RECV_SIZE)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(echo, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    packets = [trpc_msg.TrpcPacket(service='Request', method='HeatSetpoint',
+                    address=1001, setpoint=70),
+            trpc_msg.TrpcPacket(serviceID=1, methodID=0x1FF),
+            trpc_msg.TrpcPacket.build('Report', 'CurrentTemperature',
+                    address=7, temp=650)]
+    expected = [str(p) for p in packets]
+
+    failures = 0
+    for binary in (False, True):
+        sock = AsyncTrpcSocket('127.0.0.1', port, binary)
+        if not await sock.open():
+            print('FAIL: could not connect to the echo server')
+            failures += 1
+            continue
+        await sock.write(packets[0])
+        await sock.write_many(packets[1:])
+        received = []
+        while len(received) < len(packets):
+            p = await sock.read(timeout=5)
+            if p is None:
+                break
+            received.append(str(p))
+        await sock.close()
+
+        if received != expected:
+            print('FAIL: %s round trip: %r' % (binary and 'binary' or 'string',
+                    received))
+            failures += 1
+
+    server.close()
+    await server.wait_closed()
+    return failures
+
+
+#******************************************************************************
+if __name__ == '__main__':
+    import sys
+
+    failures = asyncio.run(check())
+    if failures:
+        print('%d failures.' % failures)
+        sys.exit(1)
+    print('All checks passed.')
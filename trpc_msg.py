@@ -11,46 +11,38 @@
 
 
 #*****************************************************************************
+import binascii
+import struct
 import packet
-from fields import Record, FieldList, Int8, Int16, Int32
+import trpc_schema
+from fields import Record, LazyRecord, FieldList, Int8, Int16, Int24, Int32, \
+        LITTLE_ENDIAN, BIG_ENDIAN
 
 
 #*****************************************************************************
-# Define the formats of tRPC messages according to their method ID.
+# Define the formats of tRPC messages according to their service and method
+# IDs.  The formats are built from the protocol schema (see trpc_schema.py).
 #
+_schema = trpc_schema.load()
+
+_byte_order = {'<' : LITTLE_ENDIAN, '>' : BIG_ENDIAN}[_schema['byte_order']]
+_field_types = {'Int16' : Int16, 'Int24' : Int24, 'Int32' : Int32}
+
+def _field_list(name, fields):
+    """ Return a FieldList from a schema entry's (field name, type name)
+        tuples.
+        """
+    lst = []
+    for field_name, type in fields:
+        if type == 'Int8':
+            lst.append(Int8(field_name))
+        else:
+            lst.append(_field_types[type](field_name, _byte_order))
+    return FieldList(name, *lst)
+
 empty_field_list = FieldList('empty_field_list')
 
-# Note that the bitfields read starting from the LSB and working downwards.
-# Also note that this table assumes little-endian byte-ordering.
-
-service_formats = {
-
-        #*********************************************************************
-        0x00   :   FieldList(
-            'Update',
-            ),
-
-        #*********************************************************************
-        0x01   :   FieldList(
-            'Request',
-            ),
-        
-        #*********************************************************************
-        0x02   :   FieldList(
-            'Report',
-            ),
-        
-        #*********************************************************************
-        0x03   :   FieldList(
-            'Response:Update',
-            ),
-        
-        #*********************************************************************
-        0x04   :   FieldList(
-            'Response:Request',
-            ),
-
-        }
+service_formats = dict([(i, FieldList(name)) for i, name in _schema['services']])
 
 #*****************************************************************************
 # Lookup service IDs from service names.
@@ -64,162 +56,8 @@ name_from_serviceID = dict(zip(service_formats.keys(),
 #
 serviceID_from_name = dict(zip(name_from_serviceID.values(), name_from_serviceID.keys()))
 
-method_formats = {
-
-        #*********************************************************************
-        0x00000000   :   FieldList(
-            'NullMethod',
-            ),
-
-        #*********************************************************************
-        0x00000107   :   FieldList(
-            'NetworkError',
-                Int16('error')
-            ),
-        
-        #*********************************************************************
-        0x0000010F   :   FieldList(
-            'ReportingState',
-                Int8('state')
-            ),
-
-        #*********************************************************************
-        0x00000117   :   FieldList(
-            'OutdoorTemp',
-                Int16('temp')
-            ),
-        
-        #*********************************************************************
-        0x0000011F   :   FieldList(
-            'DeviceAttributes',
-                Int16('address'),
-                Int16('attributes')
-            ),
-        
-        #*********************************************************************
-        0x00000127   :   FieldList(
-            'ModeSetting',
-                Int16('address'),
-                Int8('mode')
-            ),
-
-        #*********************************************************************
-        0x0000012F   :   FieldList(
-            'ActiveDemand',
-                Int16('address'),
-                Int8('demand')
-            ),
-
-        #*********************************************************************
-        0x00000137   :   FieldList(
-            'CurrentTemperature',
-                Int16('address'),
-                Int16('temp')
-            ),
-        
-        #*********************************************************************
-        0x0000013F   :   FieldList(
-            'HeatSetpoint',
-                Int16('address'),
-                Int8('setback'),
-                Int8('setpoint')
-            ),
-        
-        #*********************************************************************
-        0x00000147   :   FieldList(
-            'CoolSetpoint',
-                Int16('address'),
-                Int8('setback'),
-                Int8('setpoint')
-            ),
-        
-        #*********************************************************************
-        0x0000014F   :   FieldList(
-            'SlabSetpoint',
-                Int16('address'),
-                Int8('setback'),
-                Int8('setpoint')
-            ),
-
-        #*********************************************************************
-        0x00000157   :   FieldList(
-            'FanPercent',
-                Int16('address'),
-                Int8('setback'),
-                Int8('percent')
-            ),
-
-        #*********************************************************************
-        0x0000015F   :   FieldList(
-            'TakingAddress',
-                Int16('old_address'),
-                Int16('new_address')
-            ),
-
-        #*********************************************************************
-        0x00000167   :   FieldList(
-            'DeviceInventory',
-                Int16('address'),
-            ),
-
-        #*********************************************************************
-        0x0000016F   :   FieldList(
-            'SetbackEnable',
-                Int8('enable')
-            ),
-
-        #*********************************************************************
-        0x00000177   :   FieldList(
-            'SetbackState',
-                Int16('address'),
-                Int8('setback')
-            ),
-
-        #*********************************************************************
-        0x0000017F   :   FieldList(
-            'SetbackEvents',
-                Int16('address'),
-                Int8('events')
-            ),
-
-        #*********************************************************************
-        0x00000187   :   FieldList(
-            'FirmwareRevision',
-                Int16('revision'),
-            ),
-        
-        #*********************************************************************
-        0x0000018F   :   FieldList(
-            'ProtocolVersion',
-                Int16('version'),
-            ),
-
-        #*********************************************************************
-        0x00000197   :   FieldList(
-            'DeviceType',
-                Int16('address'),
-                Int32('type')
-            ),
-
-        #*********************************************************************
-        0x0000019F   :   FieldList(
-            'DeviceVersion',
-                Int16('address'),
-                Int32('j_number')
-            ),
-
-        #*********************************************************************
-        0x000001A7   :   FieldList(
-            'DateTime',
-                Int16('year'),
-                Int8('month'),
-                Int8('day'),
-                Int8('weekday'),
-                Int8('hour'),
-                Int8('minute')
-            ),
-
-        }
+method_formats = dict([(i, _field_list(name, fields))
+        for i, name, fields, fmt in _schema['methods']])
 
 #*****************************************************************************
 # Lookup method IDs from method names.
@@ -235,17 +73,184 @@ methodID_from_name = dict(zip(name_from_methodID.values(), name_from_methodID.ke
 
 
 #*****************************************************************************
-class TrpcPacket:
+def _decode_record(field_list, data, offset, compact, lazy):
+    """ Decode a record of the given format from data, starting at offset,
+        as a LazyRecord, SlotRecord, or Record (see TrpcPacket.from_rx_packet).
+
+        Return the record and the offset just past it as a tuple.
+        """
+    if lazy:
+        return field_list.lazy_record_class().decode(data, offset)
+    elif compact:
+        return field_list.record_class().decode(data, offset)
+    else:
+        return Record.decode(field_list, data, offset)
+
+
+#*****************************************************************************
+class _Decoder(object):
+    """ Decodes the header and body of a packet with one known method ID in
+        a single step, using one struct for both.  See decoder_from_methodID.
+        """
+
+    #-------------------------------------------------------------------------
+    def __init__(self, header_format, body_format, fmt):
+        """ Build the decoder from the struct format of the header and body
+            together, as worked out by trpc_schema.
+            """
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+
+        self.header_format = header_format
+        self.header_names = header_format.field_names
+        self.header_count = len(self.header_names)
+        self.header_class = header_format.record_class()
+        self.body_format = body_format
+        self.body_names = body_format.field_names
+        self.body_class = body_format.record_class()
+        self.header_slots = self.header_class.slot_names
+        self.body_slots = self.body_class.slot_names
+
+
+    #-------------------------------------------------------------------------
+    def decode(self, trpc, data, compact):
+        """ Fill in the header, body and extra data of trpc from data.  See
+            TrpcPacket.from_rx_packet for compact.
+            """
+        vals = self.struct.unpack_from(data)
+        n = self.header_count
+        if compact:
+            trpc.header = self.header_class(vals[:n])
+            trpc.body = self.body_class(vals[n:])
+        else:
+            trpc.header = Record(self.header_format)
+            trpc.header.values = dict(zip(self.header_names, vals[:n]))
+            trpc.body = Record(self.body_format)
+            trpc.body.values = dict(zip(self.body_names, vals[n:]))
+        trpc.extra = list(data[self.size:])
+
+
+    #-------------------------------------------------------------------------
+    def decode_into(self, trpc, data):
+        """ Fill in the header, body and extra data of a PooledTrpcPacket of
+            this decoder's method from data, reusing its records and extra
+            data list.
+            """
+        vals = self.struct.unpack_from(data)
+        header = trpc.header
+        for s, v in zip(self.header_slots, vals):
+            setattr(header, s, v)
+        body = trpc.body
+        for s, v in zip(self.body_slots, vals[self.header_count:]):
+            setattr(body, s, v)
+        extra = trpc.extra
+        if extra or len(data) > self.size:
+            extra[:] = data[self.size:]
+
+
+    #-------------------------------------------------------------------------
+    def pooled_packet(self, pool):
+        """ Return a new, empty PooledTrpcPacket of this decoder's method for
+            a pool.
+            """
+        trpc = PooledTrpcPacket.__new__(PooledTrpcPacket)
+        trpc.header = self.header_class()
+        trpc.body = self.body_class()
+        trpc.extra = []
+        trpc.pool = pool
+        trpc.decoder = self
+        trpc.in_use = False
+        return trpc
+
+
+#*****************************************************************************
+class _Encoder:
+    """ Encodes packets with one service ID and method ID.  The header bytes
+        never change, so each packet starts as a copy of a pre-encoded
+        template and only the body is packed into it.  See encoder_for.
+        """
+
+    #-------------------------------------------------------------------------
+    def __init__(self, serviceID, methodID):
+        header_format = TrpcPacket.format
+        self.body_format = method_formats.get(methodID, empty_field_list)
+        self.body_names = self.body_format.field_names
+        self.body_codec = self.body_format.compile()
+        self.header_size = header_format.size
+        self.header_class = header_format.lazy_record_class()
+        self.body_class = self.body_format.lazy_record_class()
+
+        self.template = bytearray(header_format.size + self.body_format.size)
+        header_format.compile().pack_into(self.template, 0, [serviceID, methodID])
+
+
+    #-------------------------------------------------------------------------
+    def encode(self, body):
+        """ Return the packet data (a bytearray) for a body record of this
+            encoder's method.
+            """
+        data = bytearray(self.template)
+        if self.body_names:
+            self.body_codec.pack_into(data, self.header_size,
+                    [body[n] for n in self.body_names])
+        return data
+
+
+    #-------------------------------------------------------------------------
+    def build(self, values):
+        """ Return a TrpcPacket with the body fields given in the values
+            dictionary filled in (the others are zero).  The header and body
+            are LazyRecords holding the encoded bytes.
+            """
+        data = bytearray(self.template)
+        if values:
+            self.body_codec.pack_into(data, self.header_size,
+                    [values.get(n, 0) for n in self.body_names])
+        trpc = TrpcPacket.__new__(TrpcPacket)
+        trpc.header = self.header_class()
+        trpc.header.raw = data[:self.header_size]
+        trpc.body = self.body_class()
+        trpc.body.raw = data[self.header_size:]
+        trpc.extra = []
+        return trpc
+
+
+#*****************************************************************************
+_encoders = {}
+
+def encoder_for(serviceID, methodID):
+    """ Return the _Encoder for a service ID and method ID.  Encoders for the
+        defined services and methods are cached.
+        """
+    key = (serviceID, methodID)
+    try:
+        return _encoders[key]
+    except KeyError:
+        encoder = _Encoder(serviceID, methodID)
+        if serviceID in service_formats and methodID in method_formats:
+            _encoders[key] = encoder
+        return encoder
+
+
+#*****************************************************************************
+def _raw_bytes(record):
+    """ Return the bytes of a LazyRecord that has all of its bytes and has
+        not been modified, otherwise None.
+        """
+    if isinstance(record, LazyRecord) and not record.modified \
+            and len(record.raw) == record.fields.size:
+        return record.raw
+    return None
+
+
+#*****************************************************************************
+class TrpcPacket(object):
 
     #*************************************************************************
     # Format of all tRPC packets (except the message body - that has to be
     # determined based on method ID.
     #
-    format = FieldList(
-                'header',
-                    Int8('serviceID'),
-                    Int32('methodID')
-                )
+    format = _field_list('header', _schema['header'])
 
     #*************************************************************************
     def __init__(self, **kwargs):
@@ -320,27 +325,111 @@ class TrpcPacket:
                 self.header[v] = kwargs[v]
 
     #*************************************************************************
-    def from_rx_packet(pck_str):
+    def from_rx_packet(pck_str, compact=False, lazy=False, pool=None):
         """ Create a TrpcPacket from a packet string (as it would be received
             from a socket connection.
+
+            If compact is True, the header and body are SlotRecords rather
+            than Records.  They behave the same but use a fraction of the
+            memory, which matters when a lot of packets are kept around.
+
+            If lazy is True, the header and body are LazyRecords, which only
+            decode the fields that are actually read.  This suits code that
+            just routes or filters packets.
+
+            If a PacketPool is given, the packet is decoded in to a recycled
+            packet from the pool instead (compact and lazy are ignored), and
+            should be released when done with.  See PacketPool.
             """
-        p = packet.Packet.from_str(pck_str)
-        if p.type != packet.TYPE_TRPC:
+        if pool is not None:
+            return pool.from_rx_packet(pck_str)
+        return TrpcPacket.from_packet(packet.Packet.from_str(pck_str), compact, lazy)
+
+    from_rx_packet = staticmethod(from_rx_packet)
+
+
+    #*************************************************************************
+    def from_packet(p, compact=False, lazy=False, pool=None):
+        """ Create a TrpcPacket from a Packet object, e.g. one received as a
+            binary frame.  See from_rx_packet for compact, lazy and pool.
+
+            Return None if the packet is not a tRPC packet.
+            """
+        if pool is not None:
+            return pool.from_packet(p)
+
+        elif p.type != packet.TYPE_TRPC:
             return None
 
         else:
-            trpc = TrpcPacket()
-            trpc.header, d = Record.create(TrpcPacket.format, p.data)
+            data = p.data
+            if isinstance(data, list):
+                data = bytearray(data)
+
+            # The header and body are filled in here, so skip __init__.
+            trpc = TrpcPacket.__new__(TrpcPacket)
+
+            # Use the method's own decoder if there is one and the packet is
+            # long enough for it.
+            if not lazy and len(data) >= _header_size:
+                decoder = decoder_from_methodID.get(
+                        _methodID_struct.unpack_from(data, _methodID_offset)[0])
+                if decoder is not None and len(data) >= decoder.size:
+                    decoder.decode(trpc, data, compact)
+                    return trpc
+
+            # Otherwise decode the header and body straight out of the packet
+            # data, field list by field list.
+            trpc.header, offset = _decode_record(TrpcPacket.format, data, 0,
+                    compact, lazy)
+            format = method_formats.get(trpc.header['methodID'], empty_field_list)
+            trpc.body, offset = _decode_record(format, data, offset, compact, lazy)
+            trpc.extra = list(data[offset:])
 
-            try:
-                trpc.body, trpc.extra = Record.create(method_formats[trpc.header['methodID']], d)
+            return trpc
 
-            except KeyError:
-                trpc.body, trpc.extra = Record.create(empty_field_list, d)
+    from_packet = staticmethod(from_packet)
 
-            return trpc
 
-    from_rx_packet = staticmethod(from_rx_packet)
+    #*************************************************************************
+    def build(service, method, **values):
+        """ Create a TrpcPacket for sending, e.g.
+                TrpcPacket.build('Request', 'HeatSetpoint', address=1001)
+
+            The service and method can be given by name or ID.  The keyword
+            arguments are values for body fields; any others are ignored, as
+            with the TrpcPacket constructor.  Unlike the constructor, an
+            unknown service or method name raises a KeyError.
+
+            The packet is encoded straight from a cached template for the
+            service and method, and to_tpck just hands over its bytes for as
+            long as it is not modified.
+            """
+        if not isinstance(service, int):
+            service = serviceID_from_name[service]
+        if not isinstance(method, int):
+            method = methodID_from_name[method]
+        return encoder_for(service, method).build(values)
+
+    build = staticmethod(build)
+
+
+    #*************************************************************************
+    def release(self):
+        """ Hand the packet back to the PacketPool it was decoded from, once
+            it is no longer needed.  Packets that are not from a pool are
+            left to the garbage collector, so this does nothing.
+            """
+        pass
+
+
+    #*************************************************************************
+    def detach(self):
+        """ Return a packet with the same contents that does not belong to a
+            PacketPool and so can be kept.  A packet that is not from a pool
+            is returned as it is.
+            """
+        return self
 
 
     #*************************************************************************
@@ -352,8 +441,19 @@ class TrpcPacket:
             """
         p = packet.Packet()
         p.type = packet.TYPE_TRPC
-        p.data = self.header.pack()[0]
-        p.data.extend(self.body.pack()[0])
+
+        header = _raw_bytes(self.header)
+        body = _raw_bytes(self.body)
+        if header is not None and body is not None:
+            # Built (or lazily decoded) and not changed since.
+            p.data = header + body
+        else:
+            encoder = encoder_for(self.header['serviceID'], self.header['methodID'])
+            if self.body.fields is encoder.body_format:
+                p.data = encoder.encode(self.body)
+            else:
+                p.data = self.header.pack()[0]
+                p.data.extend(self.body.pack()[0])
         p.data.extend(self.extra)
         return p
 
@@ -382,3 +482,305 @@ class TrpcPacket:
         else:
             return ''.join([hs, ' <', ''.join(['%02X' % x for x in d]), '>'])
 
+
+
+#*****************************************************************************
+# Decoders for the defined methods, by method ID.  Methods whose format can
+# not be decoded by a single struct are left out and decoded field list by
+# field list.
+#
+decoder_from_methodID = dict([(i, _Decoder(TrpcPacket.format, method_formats[i], fmt))
+        for i, name, fields, fmt in _schema['methods'] if fmt is not None])
+
+_header_size = TrpcPacket.format.size
+_methodID_offset = TrpcPacket.format.offsets()['methodID'][0]
+_methodID_struct = struct.Struct(_schema['byte_order'] +
+        trpc_schema.field_codes[dict(_schema['header'])['methodID']])
+
+
+#*****************************************************************************
+# Number of released packets a PacketPool holds on to by default.
+#
+POOL_SIZE = 256
+
+
+#*****************************************************************************
+class PooledTrpcPacket(TrpcPacket):
+    """ TrpcPacket that is recycled by a PacketPool.  The header and body are
+        SlotRecords that are filled in again each time the packet is reused.
+        """
+
+    __slots__ = ('header', 'body', 'extra', 'pool', 'decoder', 'in_use')
+
+    #*************************************************************************
+    def release(self):
+        """ Hand the packet back to its pool.  The packet must not be used
+            after this.
+            """
+        self.pool.release(self)
+
+
+    #*************************************************************************
+    def detach(self):
+        """ Return a copy of the packet, with SlotRecords for the header and
+            body, that does not belong to the pool.  The pooled packet still
+            has to be released.
+            """
+        trpc = TrpcPacket.__new__(TrpcPacket)
+        trpc.header = self.header.__class__(self.header.value_list())
+        trpc.body = self.body.__class__(self.body.value_list())
+        trpc.extra = list(self.extra)
+        return trpc
+
+
+#*****************************************************************************
+class PacketPool:
+    """ Bounded free list of packets for the receive path.
+
+        Decoding through a pool fills in a released packet of the same method,
+        header and body records included, instead of allocating a Packet, two
+        records and a TrpcPacket for every packet received, e.g.
+
+            pool = trpc_msg.PacketPool()
+            for line in lines:
+                trpc = trpc_msg.TrpcPacket.from_rx_packet(line, pool=pool)
+                if trpc is not None:
+                    handle(trpc)
+                    trpc.release()
+
+        A packet must not be used after it has been released, as the next
+        packet of its method will overwrite it.  Use detach() to keep a copy.
+        Released packets beyond the pool's size are dropped.
+
+        Only methods in decoder_from_methodID are pooled.  Other packets (and
+        packets too short for their method) are decoded as compact
+        TrpcPackets, for which release() does nothing.
+        """
+
+    #-------------------------------------------------------------------------
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.free = {}
+        self.free_count = 0
+
+        # Number of packets allocated and reused, for tuning the size.
+        self.created = 0
+        self.reused = 0
+
+
+    #-------------------------------------------------------------------------
+    def from_rx_packet(self, pck_str):
+        """ Decode a packet string in to a pooled packet.  The same as
+            TrpcPacket.from_rx_packet, but without the Packet object.
+            """
+        data = packet.Packet.bytes_from_str(pck_str)
+        if len(data) == 0 or data[0] != packet.TYPE_TRPC:
+            return None
+        return self.decode(data[1:])
+
+
+    #-------------------------------------------------------------------------
+    def from_packet(self, p):
+        """ Decode a Packet object in to a pooled packet.  The same as
+            TrpcPacket.from_packet.
+            """
+        if p.type != packet.TYPE_TRPC:
+            return None
+        data = p.data
+        if isinstance(data, list):
+            data = bytearray(data)
+        return self.decode(data)
+
+
+    #-------------------------------------------------------------------------
+    def decode(self, data):
+        """ Decode the data of a tRPC packet in to a packet from the free
+            list, or a new one if there is none for its method.
+            """
+        decoder = None
+        if len(data) >= _header_size:
+            decoder = decoder_from_methodID.get(
+                    _methodID_struct.unpack_from(data, _methodID_offset)[0])
+        if decoder is None or len(data) < decoder.size:
+            return TrpcPacket.from_packet(packet.Packet(packet.TYPE_TRPC, data), True)
+
+        try:
+            trpc = self.free[decoder].pop()
+            self.free_count -= 1
+            self.reused += 1
+        except (KeyError, IndexError):
+            trpc = decoder.pooled_packet(self)
+            self.created += 1
+        decoder.decode_into(trpc, data)
+        trpc.in_use = True
+        return trpc
+
+
+    #-------------------------------------------------------------------------
+    def release(self, trpc):
+        """ Put a packet decoded by this pool back on the free list.
+            Releasing a packet more than once has no effect.
+            """
+        if trpc.in_use:
+            trpc.in_use = False
+            if self.free_count < self.size:
+                try:
+                    self.free[trpc.decoder].append(trpc)
+                except KeyError:
+                    self.free[trpc.decoder] = [trpc]
+                self.free_count += 1
+
+
+#*****************************************************************************
+# Method IDs of the methods whose body starts with a 16-bit address field.
+#
+address_methods = frozenset(_schema['address_methods'])
+
+_peek_header_struct = TrpcPacket.format.compile().struct
+_peek_address_struct = struct.Struct(_peek_header_struct.format + 'H')
+_peek_address_size = _peek_address_struct.size
+
+
+#*****************************************************************************
+def peek(payload):
+    """ Read the routing information from the payload (str, bytearray, ...)
+        of a tRPC packet without decoding the rest of it.
+
+        Return a (serviceID, methodID, address) tuple.  The address is None
+        if the method is not in address_methods or the payload is too short
+        to hold it.  Return None if the payload is too short for a header.
+        """
+    if len(payload) >= _peek_address_size:
+        serviceID, methodID, address = _peek_address_struct.unpack_from(payload)
+        if methodID in address_methods:
+            return serviceID, methodID, address
+        return serviceID, methodID, None
+    if len(payload) >= _header_size:
+        serviceID, methodID = _peek_header_struct.unpack_from(payload)
+        return serviceID, methodID, None
+    return None
+
+
+#*****************************************************************************
+def peek_line(line):
+    """ The same as peek, but for a packet string (a line of hex as sent by
+        packserv, as a str or bytearray).  Only the start of the line is
+        decoded.
+
+        Return None if the line is not a tRPC packet or is too short.
+        """
+    try:
+        data = bytearray(binascii.unhexlify(
+                line[:2 + 2 * _peek_address_size].rstrip()))
+    except (TypeError, ValueError):
+        # Odd length or not hex.
+        return None
+    if len(data) == 0 or data[0] != packet.TYPE_TRPC:
+        return None
+    return peek(data[1:])
+
+
+#*****************************************************************************
+class RouteFilter:
+    """ Selects tRPC packets by service ID, method ID and address, i.e. by
+        the routing information that peek reads.  Each of them is either
+        None (anything) or, for services and methods, a set of IDs and, for
+        addresses, an inclusive (low, high) range.  A packet without an
+        address never matches an address range.
+
+        Filters are sent to the packet server as commands of the form
+            FILTER service=ID,... method=ID,... address=LOW-HIGH
+        where each part is optional and IDs can also be names.  See
+        TrpcSocket.add_filter.
+        """
+
+    #-------------------------------------------------------------------------
+    def __init__(self, services=None, methods=None, addresses=None):
+        """ services and methods are sequences of IDs or names.  addresses
+            is a (low, high) tuple, or a single address.
+            """
+        if services is not None:
+            services = frozenset([_lookup(s, serviceID_from_name) for s in services])
+        if methods is not None:
+            methods = frozenset([_lookup(m, methodID_from_name) for m in methods])
+        if addresses is not None and not isinstance(addresses, tuple):
+            addresses = (addresses, addresses)
+        self.services = services
+        self.methods = methods
+        self.addresses = addresses
+
+
+    #-------------------------------------------------------------------------
+    def match(self, serviceID, methodID, address):
+        """ Return True if a packet with the given routing information (see
+            peek) passes the filter.
+            """
+        if self.services is not None and serviceID not in self.services:
+            return False
+        if self.methods is not None and methodID not in self.methods:
+            return False
+        if self.addresses is not None:
+            if address is None or not self.addresses[0] <= address <= self.addresses[1]:
+                return False
+        return True
+
+
+    #-------------------------------------------------------------------------
+    def to_command(self):
+        """ Return the filter as a packet server command.
+            """
+        parts = ['FILTER']
+        if self.services is not None:
+            parts.append('service=' + ','.join(['0x%X' % i for i in sorted(self.services)]))
+        if self.methods is not None:
+            parts.append('method=' + ','.join(['0x%X' % i for i in sorted(self.methods)]))
+        if self.addresses is not None:
+            parts.append('address=%d-%d' % self.addresses)
+        return ' '.join(parts)
+
+
+    #-------------------------------------------------------------------------
+    def from_command(command):
+        """ Create a RouteFilter from a packet server command (see
+            to_command).
+
+            ValueError is raised if the command is not a valid FILTER
+            command.
+            """
+        words = command.split()
+        if words[:1] != ['FILTER']:
+            raise ValueError('Not a FILTER command: %r' % command)
+        args = {}
+        for word in words[1:]:
+            name, _, value = word.partition('=')
+            if name not in ('service', 'method', 'address') or not value:
+                raise ValueError('Invalid filter: %r' % word)
+            args[name] = value
+
+        try:
+            services = methods = addresses = None
+            if 'service' in args:
+                services = args['service'].split(',')
+            if 'method' in args:
+                methods = args['method'].split(',')
+            if 'address' in args:
+                low, _, high = args['address'].partition('-')
+                addresses = (int(low, 0), int(high or low, 0))
+            return RouteFilter(services, methods, addresses)
+        except KeyError:
+            raise ValueError('Unknown name in filter: %r' % command)
+
+    from_command = staticmethod(from_command)
+
+
+#*****************************************************************************
+def _lookup(value, id_from_name):
+    """ Return the ID for a name, or for an ID given as an int or a string
+        (decimal or 0x hex).  Raise KeyError if it is neither.
+        """
+    if isinstance(value, int):
+        return value
+    try:
+        return int(value, 0)
+    except ValueError:
+        return id_from_name[value]
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+""" Shared packet server connection for a whole process.
+
+    Every TrpcSocket is a connection of its own, and the packet server sends
+    each of them a copy of every packet.  A Multiplexer owns one connection,
+    decodes each packet once, and hands it to any number of Subscribers,
+    which read and write like TrpcSockets, e.g.
+
+        mux = trpc_mux.shared()
+        temps = mux.subscribe(lambda p: p.header['methodID'] == temp_id)
+        for p in temps:
+            print p.body['temp']
+
+    A Subscriber can stand in for a TrpcSocket, e.g. under a
+    trpc_request.Requester.
+
+    Each subscriber has a bounded queue:  if it falls behind, its oldest
+    packets are dropped (and counted), without holding up the others.  An
+    optional filter (a function of a TrpcPacket returning True for the
+    packets wanted) keeps other packets out of the queue altogether.
+
+    Packets are received on a thread of the multiplexer's own, and one packet
+    object is shared by all the subscribers that get it, so they must not
+    modify it.  A subscriber whose filter raises an exception is unsubscribed
+    (see Subscriber.error) rather than holding up the others.  Writes from
+    all subscribers go out through the one connection.
+    """
+
+
+#*****************************************************************************
+import sys
+import threading
+import traceback
+import collections
+
+import trpc_sock
+
+from get_trpc_host import get_trpc_host
+
+
+#*****************************************************************************
+# Number of packets a subscriber's queue holds by default.
+QUEUE_SIZE = 1000
+
+# Seconds between checks by the receive thread for the multiplexer closing.
+POLL_INTERVAL = 0.5
+
+
+#*****************************************************************************
+class Subscriber:
+    """ A user of a Multiplexer.  See Multiplexer.subscribe.
+        """
+
+    #-------------------------------------------------------------------------
+    def __init__(self, mux, filter, queue_size):
+        self.mux = mux
+        self.filter = filter
+        self.rx_queue = collections.deque(maxlen=queue_size)
+        self.ready = threading.Condition(threading.Lock())
+
+        # Number of packets dropped because the queue was full.
+        self.dropped = 0
+        self.subscribed = True
+
+        # The exception that got the subscriber unsubscribed, if any.
+        self.error = None
+
+
+    #-------------------------------------------------------------------------
+    def is_open(self):
+        """ True while packets can arrive, i.e. until the subscriber or the
+            multiplexer is closed.
+            """
+        return self.subscribed and self.mux.is_open
+
+    is_open = property(is_open)
+
+    #-------------------------------------------------------------------------
+    def IsOpen(self):
+        return self.is_open
+
+    #-------------------------------------------------------------------------
+    def close(self):
+        """ Stop receiving packets.  The multiplexer stays open.
+            """
+        self.mux.unsubscribe(self)
+
+
+    #-------------------------------------------------------------------------
+    def put(self, packets):
+        """ Queue received packets.  Called by the receive thread.
+            """
+        self.ready.acquire()
+        try:
+            queue = self.rx_queue
+            for p in packets:
+                if len(queue) == queue.maxlen:
+                    self.dropped += 1
+                queue.append(p)
+            self.ready.notify_all()
+        finally:
+            self.ready.release()
+
+
+    #-------------------------------------------------------------------------
+    def wake(self):
+        """ Wake up readers, e.g. because the connection closed.
+            """
+        self.ready.acquire()
+        try:
+            self.ready.notify_all()
+        finally:
+            self.ready.release()
+
+
+    #-------------------------------------------------------------------------
+    def __iter__(self):
+        """ Iterate over the packets received until the subscriber or the
+            multiplexer is closed.
+            """
+        return self.packets()
+
+
+    #-------------------------------------------------------------------------
+    def packets(self, timeout=None):
+        """ Generate the packets received until the subscriber or the
+            multiplexer is closed, or until no packet has arrived for timeout
+            seconds.
+            """
+        while True:
+            p = self.read(timeout)
+            if p is None:
+                return
+            yield p
+
+
+    #-------------------------------------------------------------------------
+    def read(self, timeout=0):
+        """ Read a packet.  As with TrpcSocket.read, None is returned at once
+            if no packet has been queued, unless a timeout is given.
+
+            Return a TrpcPacket object, or None if there was none, the time
+            ran out or the subscriber or the multiplexer is closed.
+            """
+        packets = self.read_many(1, timeout)
+        if packets:
+            return packets[0]
+        return None
+
+
+    #-------------------------------------------------------------------------
+    def read_many(self, max_count=None, timeout=0):
+        """ Read every packet that has been queued, or at most max_count of
+            them, waiting for one if a timeout is given as for read.
+
+            Return a list of TrpcPacket objects, which is empty if there was
+            none, the time ran out or the subscriber or the multiplexer is
+            closed.
+            """
+        packets = []
+        self.ready.acquire()
+        try:
+            queue = self.rx_queue
+            if not queue and self.is_open and timeout != 0:
+                # Condition.wait wakes up on its own after timeout seconds,
+                # so there is no need to work out a deadline.
+                self.ready.wait(timeout)
+            if max_count is None or max_count >= len(queue):
+                packets.extend(queue)
+                queue.clear()
+            else:
+                for i in range(max_count):
+                    packets.append(queue.popleft())
+        finally:
+            self.ready.release()
+        return packets
+
+
+    #-------------------------------------------------------------------------
+    def write(self, trpc_packet):
+        """ Write a TrpcPacket object through the multiplexer's connection.
+            """
+        self.mux.write(trpc_packet)
+
+
+    #-------------------------------------------------------------------------
+    def write_many(self, trpc_packets):
+        """ Write a sequence of TrpcPacket objects through the multiplexer's
+            connection.
+            """
+        self.mux.write_many(trpc_packets)
+
+
+#*****************************************************************************
+class Multiplexer:
+    """ One packet server connection shared by many Subscribers.
+        """
+
+    #-------------------------------------------------------------------------
+    def __init__(self, addr=None, port=None, binary=False):
+        """ Create the multiplexer.  The arguments are the same as for
+            trpc_sock.TrpcSocket.
+            """
+        self.sock = trpc_sock.TrpcSocket(addr, port, binary)
+        self.is_open = False
+        self.thread = None
+
+        # The tuple is replaced rather than changed, so the receive thread
+        # can go through it without a lock.
+        self.subscribers = ()
+        self.subscribe_lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+
+    #-------------------------------------------------------------------------
+    def open(self):
+        """ Connect to the packet server and start receiving.
+
+            Return True if successful, False if not.
+            """
+        if not self.sock.open():
+            return False
+        self.is_open = True
+        self.thread = threading.Thread(target=self.run, name='trpc_mux')
+        self.thread.daemon = True
+        self.thread.start()
+        return True
+
+
+    #-------------------------------------------------------------------------
+    def close(self):
+        """ Stop receiving and close the connection.  Subscribers waiting for
+            packets return.
+            """
+        if self.is_open:
+            self.is_open = False
+            if self.thread is not threading.current_thread():
+                self.thread.join()
+            self.write_lock.acquire()
+            try:
+                self.sock.close()
+            finally:
+                self.write_lock.release()
+        for s in self.subscribers:
+            s.wake()
+
+
+    #-------------------------------------------------------------------------
+    def subscribe(self, filter=None, queue_size=QUEUE_SIZE):
+        """ Add a subscriber.  If a filter function is given, only the
+            packets that it returns True for are queued for the subscriber.
+            At most queue_size packets are queued.
+
+            Return the Subscriber.
+            """
+        sub = Subscriber(self, filter, queue_size)
+        self.subscribe_lock.acquire()
+        try:
+            self.subscribers = self.subscribers + (sub,)
+        finally:
+            self.subscribe_lock.release()
+        return sub
+
+
+    #-------------------------------------------------------------------------
+    def unsubscribe(self, sub):
+        """ Remove a subscriber.  Its queued packets can still be read.
+            """
+        self.subscribe_lock.acquire()
+        try:
+            self.subscribers = tuple([s for s in self.subscribers if s is not sub])
+        finally:
+            self.subscribe_lock.release()
+        sub.subscribed = False
+        sub.wake()
+
+
+    #-------------------------------------------------------------------------
+    def run(self):
+        """ Receive packets and hand them to the subscribers, until the
+            multiplexer or the connection is closed.  This is the receive
+            thread.
+            """
+        sock = self.sock
+        try:
+            while self.is_open and sock.is_open:
+                packets = sock.read_many(timeout=POLL_INTERVAL)
+                if packets:
+                    for s in self.subscribers:
+                        self.deliver(s, packets)
+        finally:
+            if self.is_open:
+                # The server closed the connection, or the thread failed:
+                # either way, wake up the subscribers' readers.
+                self.close()
+
+
+    #-------------------------------------------------------------------------
+    def deliver(self, sub, packets):
+        """ Queue the packets that pass a subscriber's filter for it.  If the
+            filter fails, the subscriber is unsubscribed, so that one faulty
+            subscriber does not stop the rest.
+            """
+        try:
+            if sub.filter is None:
+                sub.put(packets)
+            else:
+                wanted = [p for p in packets if sub.filter(p)]
+                if wanted:
+                    sub.put(wanted)
+        except Exception as e:
+            sys.stderr.write('trpc_mux: subscriber failed, unsubscribing it:\n')
+            traceback.print_exc()
+            sub.error = e
+            self.unsubscribe(sub)
+
+
+    #-------------------------------------------------------------------------
+    def write(self, trpc_packet):
+        """ Write a TrpcPacket object to the connection.
+            """
+        self.write_lock.acquire()
+        try:
+            self.sock.write(trpc_packet)
+        finally:
+            self.write_lock.release()
+
+
+    #-------------------------------------------------------------------------
+    def write_many(self, trpc_packets):
+        """ Write a sequence of TrpcPacket objects to the connection in one
+            go.
+            """
+        self.write_lock.acquire()
+        try:
+            self.sock.write_many(trpc_packets)
+        finally:
+            self.write_lock.release()
+
+
+#*****************************************************************************
+_shared = {}
+_shared_lock = threading.Lock()
+
+def shared(addr=None, port=None, binary=False):
+    """ Return the process-wide Multiplexer for a packet server (the one
+        configured by get_trpc_host by default), connecting to it if it is
+        not connected already.  Connections with and without binary frames
+        are separate multiplexers.
+
+        Return None if the connection can not be made.
+        """
+    if addr is None or port is None:
+        a, p = get_trpc_host()
+        if addr is None:
+            addr = a
+        if port is None:
+            port = p
+
+    _shared_lock.acquire()
+    try:
+        key = (addr, port, bool(binary))
+        mux = _shared.get(key)
+        if mux is None or not mux.is_open:
+            mux = Multiplexer(addr, port, binary)
+            if not mux.open():
+                return None
+            _shared[key] = mux
+        return mux
+    finally:
+        _shared_lock.release()
@@ -13,10 +13,10 @@ def main():
         print "Could not connect to socket."
     else:
         try:
-            while True:
-                p = sock.read()
-                if p is not None:
-                    print p
+            # Blocks until each packet arrives, and ends when the packet
+            # server closes the connection.
+            for p in sock:
+                print p
         except KeyboardInterrupt:
             pass
         sock.close()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+""" Request/response correlation over a TrpcSocket.
+
+    A Request packet is answered by a Response:Request packet with the same
+    method ID, and the same address for methods that have one (see
+    trpc_msg.address_methods); likewise for Update and Response:Update.  A
+    Requester sends requests and hands back a PendingRequest for each, which
+    is resolved when the matching response arrives.
+
+    Responses are looked up in an index keyed on (service ID, method ID,
+    address), so the cost of each packet received does not depend on the
+    number of requests outstanding, and any number of requests can be in
+    flight at once, e.g.
+
+        requester = trpc_request.Requester(sock)
+        pending = [requester.request('Request', 'CurrentTemperature', address=a)
+                for a in addresses]
+        for p in pending:
+            try:
+                print p.result().body['temp']
+            except trpc_request.RequestTimeout:
+                print 'No response.'
+
+    Requests for the same method and address are answered in the order they
+    were sent.  Packets that are not responses to a pending request are kept
+    for Requester.read, up to a limit (see Requester).
+    """
+
+
+#*****************************************************************************
+import time
+import heapq
+import collections
+
+import trpc_msg
+
+
+#*****************************************************************************
+# Seconds to wait for a response.
+DEFAULT_TIMEOUT = 2.0
+
+# Number of unmatched packets kept for Requester.read by default.
+QUEUE_SIZE = 1000
+
+#*****************************************************************************
+# Service ID of the response to each service that is answered, e.g. the ID
+# of Response:Request by the ID of Request.
+#
+response_serviceID = dict([(i, trpc_msg.serviceID_from_name['Response:' + name])
+        for name, i in trpc_msg.serviceID_from_name.items()
+        if 'Response:' + name in trpc_msg.serviceID_from_name])
+
+
+#*****************************************************************************
+class RequestError(Exception):
+    """ A request failed, e.g. because the connection closed.
+        """
+    pass
+
+
+#*****************************************************************************
+class RequestTimeout(RequestError):
+    """ No response arrived in time.
+        """
+    pass
+
+
+#*****************************************************************************
+def response_key(serviceID, methodID, body):
+    """ Return the index key of a response with the given IDs and body.
+        """
+    if methodID in trpc_msg.address_methods:
+        return serviceID, methodID, body['address']
+    return serviceID, methodID, None
+
+
+#*****************************************************************************
+class PendingRequest:
+    """ Handle of a request that has been sent.  See Requester.request.
+        """
+
+    #-------------------------------------------------------------------------
+    def __init__(self, requester, key, deadline):
+        self.requester = requester
+        self.key = key
+        self.deadline = deadline
+        self.finished = False
+        self.response = None
+        self.error = None
+
+
+    #-------------------------------------------------------------------------
+    def done(self):
+        """ Return True if the response has arrived or the request failed.
+            """
+        return self.finished
+
+
+    #-------------------------------------------------------------------------
+    def result(self):
+        """ Wait for the response.  Other requests are resolved along the way,
+            so waiting on each of a batch of requests in turn takes about as
+            long as the slowest of them.
+
+            Return the response TrpcPacket.  Raise RequestTimeout if it did
+            not arrive in time, or RequestError if the connection closed.
+            """
+        while not self.finished:
+            self.requester.poll()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+    #-------------------------------------------------------------------------
+    def resolve(self, response):
+        self.finished = True
+        self.response = response
+
+
+    #-------------------------------------------------------------------------
+    def fail(self, error):
+        self.finished = True
+        self.error = error
+
+
+#*****************************************************************************
+class Requester:
+    """ Sends requests over a TrpcSocket and matches up the responses.
+        """
+
+    #-------------------------------------------------------------------------
+    def __init__(self, sock, queue_size=QUEUE_SIZE):
+        """ Use sock (a TrpcSocket, or anything that reads and writes like
+            one) for the requests.  At most queue_size packets that answer no
+            request are kept for read:  if more arrive, the oldest are
+            dropped.  A queue_size of 0 drops them all, for callers that
+            never call read.
+            """
+        self.sock = sock
+
+        # Pending requests by response key, oldest first.
+        self.index = {}
+
+        # Heap of (deadline, sequence number, PendingRequest) tuples.
+        self.deadlines = []
+        self.sequence = 0
+
+        # Received packets that did not answer a request, and the number
+        # dropped because there was no room for them.
+        self.unmatched = collections.deque(maxlen=queue_size)
+        self.dropped = 0
+
+
+    #-------------------------------------------------------------------------
+    def request(self, service, method, timeout=DEFAULT_TIMEOUT, **values):
+        """ Send a packet built by TrpcPacket.build(service, method, **values)
+            without waiting for the response.  The service must be one that is
+            answered (see response_serviceID).
+
+            Return a PendingRequest that is resolved by the response, or
+            fails if there is none within timeout seconds.
+            """
+        trpc = trpc_msg.TrpcPacket.build(service, method, **values)
+        serviceID = trpc.header['serviceID']
+        try:
+            key = response_key(response_serviceID[serviceID],
+                    trpc.header['methodID'], trpc.body)
+        except KeyError:
+            raise ValueError('service %r is not answered' % (service,))
+
+        pending = PendingRequest(self, key, time.time() + timeout)
+        try:
+            self.index[key].append(pending)
+        except KeyError:
+            self.index[key] = collections.deque([pending])
+        heapq.heappush(self.deadlines, (pending.deadline, self.sequence, pending))
+        self.sequence += 1
+
+        self.sock.write(trpc)
+        return pending
+
+
+    #-------------------------------------------------------------------------
+    def poll(self, timeout=None):
+        """ Receive packets, resolve the requests they answer and fail the
+            requests that have run out of time.  Wait at most timeout seconds
+            for a packet, or, if timeout is None, until one arrives or the
+            next request runs out of time.
+            """
+        self.expire()
+        wait = timeout
+        if self.deadlines:
+            until_next = max(self.deadlines[0][0] - time.time(), 0)
+            if wait is None or until_next < wait:
+                wait = until_next
+
+        for p in self.sock.read_many(timeout=wait):
+            self.dispatch(p)
+
+        if not self.sock.is_open:
+            self.fail_all(RequestError('connection closed'))
+        self.expire()
+
+
+    #-------------------------------------------------------------------------
+    def dispatch(self, trpc):
+        """ Resolve the oldest pending request that a received packet answers,
+            or keep the packet for read if it answers none.  Pooled packets
+            that are dropped are released.
+            """
+        header = trpc.header
+        key = response_key(header['serviceID'], header['methodID'], trpc.body)
+        waiting = self.index.get(key)
+        if waiting:
+            pending = waiting.popleft()
+            if not waiting:
+                del self.index[key]
+            # The response outlives the packet if it came from a pool.
+            pending.resolve(trpc.detach())
+            trpc.release()
+        else:
+            unmatched = self.unmatched
+            if len(unmatched) == unmatched.maxlen:
+                self.dropped += 1
+                if not unmatched:
+                    trpc.release()
+                    return
+                unmatched.popleft().release()
+            unmatched.append(trpc)
+
+
+    #-------------------------------------------------------------------------
+    def expire(self):
+        """ Fail the pending requests whose time has run out.
+            """
+        now = time.time()
+        deadlines = self.deadlines
+        while deadlines and deadlines[0][0] <= now:
+            pending = heapq.heappop(deadlines)[2]
+            if not pending.finished:
+                waiting = self.index[pending.key]
+                waiting.remove(pending)
+                if not waiting:
+                    del self.index[pending.key]
+                pending.fail(RequestTimeout('no response to %r' % (pending.key,)))
+
+
+    #-------------------------------------------------------------------------
+    def fail_all(self, error):
+        """ Fail every pending request with error.
+            """
+        for waiting in self.index.values():
+            for pending in waiting:
+                pending.fail(error)
+        self.index.clear()
+        del self.deadlines[:]
+
+
+    #-------------------------------------------------------------------------
+    def read(self, timeout=0):
+        """ Read a packet that did not answer a request.  timeout is as for
+            TrpcSocket.read.
+
+            Return a TrpcPacket object, or None if there was none, the time
+            ran out or the connection is closed.
+            """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        polled = False
+        while not self.unmatched and self.sock.is_open:
+            if timeout is None:
+                self.poll()
+            else:
+                wait = max(deadline - time.time(), 0)
+                if polled and wait == 0:
+                    break
+                self.poll(wait)
+            polled = True
+
+        if self.unmatched:
+            return self.unmatched.popleft()
+        return None
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+""" tRPC protocol schema.
+
+    The packet header, services and methods of the tRPC protocol are defined
+    once, in trpc_schema.json, and both trpc_msg and tha_demo are built from
+    that definition.  Adding a method is a matter of adding an entry to the
+    "methods" list, e.g.
+
+        {"id": "0x000001AF", "name": "VendorMethod",
+            "fields": [["address", "Int16"], ["value", "Int32"]]}
+
+    Field types are the names of the fixed-size integer fields in fields.py
+    (Int8, Int16, Int24 and Int32).  IDs are hex strings.
+
+    Loading the schema also works out the tables that the fast decoding and
+    routing paths need (struct formats, address methods).  Parsing, checking
+    and compiling the schema, and building the codecs from it in trpc_msg,
+    take about a millisecond, so nothing is cached.
+    """
+
+
+#*****************************************************************************
+import os
+import json
+
+
+#*****************************************************************************
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'trpc_schema.json')
+
+# struct format characters of the field types.  Int24 has no struct
+# equivalent.
+field_codes = { 'Int8' : 'B', 'Int16' : 'H', 'Int24' : None, 'Int32' : 'I' }
+
+byte_orders = { 'little' : '<', 'big' : '>' }
+
+
+#*****************************************************************************
+def load(path=SCHEMA_FILE):
+    """ Return the compiled schema (see compile_schema) for a schema file.
+        """
+    return compile_schema(parse(path))
+
+
+#*****************************************************************************
+def parse(path):
+    """ Read a schema file and return its contents.
+        """
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+#*****************************************************************************
+def compile_schema(source):
+    """ Check the parsed contents of a schema file and turn them in to a
+        dictionary of plain values:
+
+            byte_order      '<' or '>'
+            header          tuple of (field name, type name) tuples
+            services        tuple of (service ID, name) tuples
+            methods         tuple of (method ID, name, fields, struct format)
+                            tuples, where fields is like header.  The struct
+                            format decodes the header and body together, or
+                            is None if a field has no struct equivalent.
+            address_methods tuple of the IDs of methods whose body starts
+                            with a 16-bit address field
+
+        Raise ValueError if the schema is not valid.
+        """
+    try:
+        order = byte_orders[source.get('byte_order', 'little')]
+    except KeyError:
+        raise ValueError('unknown byte order %r' % source['byte_order'])
+
+    header = _fields(source['header'])
+    header_codes = _codes(header)
+    if header_codes is None:
+        raise ValueError('header fields must have struct equivalents')
+
+    services = []
+    for s in source['services']:
+        services.append((int(s['id'], 16), str(s['name'])))
+
+    methods = []
+    address_methods = []
+    for m in source['methods']:
+        fields = _fields(m.get('fields', ()))
+        codes = _codes(fields)
+        fmt = codes is not None and order + header_codes + codes or None
+        methods.append((int(m['id'], 16), str(m['name']), fields, fmt))
+        if fields[:1] == (('address', 'Int16'),):
+            address_methods.append(methods[-1][0])
+
+    for kind, entries in (('service', services), ('method', methods)):
+        ids = [e[0] for e in entries]
+        names = [e[1] for e in entries]
+        if len(set(ids)) != len(ids) or len(set(names)) != len(names):
+            raise ValueError('duplicate %s ID or name' % kind)
+
+    return {'byte_order' : order,
+            'header' : header,
+            'services' : tuple(services),
+            'methods' : tuple(methods),
+            'address_methods' : tuple(address_methods)}
+
+
+#*****************************************************************************
+def _fields(source):
+    """ Return a tuple of (field name, type name) tuples from the parsed list
+        of fields.
+        """
+    fields = tuple([(str(name), str(type)) for name, type in source])
+    for name, type in fields:
+        if type not in field_codes:
+            raise ValueError('unknown type %s of field %s' % (type, name))
+    return fields
+
+
+#*****************************************************************************
+def _codes(fields):
+    """ Return the struct format characters of a tuple of fields, or None if
+        any of them has no struct equivalent.
+        """
+    codes = [field_codes[type] for name, type in fields]
+    if None in codes:
+        return None
+    return ''.join(codes)
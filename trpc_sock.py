@@ -4,7 +4,11 @@
     """
 
 #******************************************************************************
+import time
+import select
 import socket
+import threading
+import collections
 
 import packet
 import trpc_msg
@@ -12,13 +16,108 @@ import trpc_msg
 from get_trpc_host import get_trpc_host
 
 
+#******************************************************************************
+# Size of the receive buffer, i.e. the most data taken from the socket at once.
+RECV_SIZE = 4096
+
+# Longest time, in seconds, that buffered writes wait to be sent by default.
+FLUSH_DELAY = 0.01
+
+
+#******************************************************************************
+def encode(trpc_packet, binary = False):
+    """ Return a TrpcPacket in the form it is sent to the packet server, i.e.
+        as a binary frame or as a packet string, as bytes.
+        """
+    return encode_packet(trpc_packet.to_tpck(), binary)
+
+
+#******************************************************************************
+def encode_packet(p, binary = False):
+    """ The same as encode, but for a Packet object.
+        """
+    if binary:
+        return bytes(p.to_frame())
+    s = str(p)
+    if not isinstance(s, bytes):
+        # Python 3:  str is text.
+        s = s.encode('ascii')
+    return s
+
+
+#******************************************************************************
+class TrpcReader:
+    """ Reassemble TrpcPackets from the data received from the packet server.
+        Partial packets are kept until the rest of them arrives.
+
+        This is the receive side of TrpcSocket, apart from the socket itself,
+        so that other clients (see trpc_async.py) decode the same way.
+        """
+
+    #**************************************************************************
+    def __init__(self, binary = False, pool = None):
+        """ See TrpcSocket for binary and pool.
+            """
+        self.binary = binary
+        self.pool = pool
+        self.reader = packet.PacketReader()
+        self.line_buffer = bytearray()
+
+
+    #**************************************************************************
+    def feed(self, data):
+        """ Add received data and return a list of the TrpcPackets that are
+            now complete.
+            """
+        packets = []
+        if self.binary:
+            # Binary frames (and any packet strings the server sent before it
+            # saw the handshake) are reassembled by the reader.
+            for p in self.reader.feed(data):
+                trpc = trpc_msg.TrpcPacket.from_packet(p, pool=self.pool)
+                if trpc is not None:
+                    packets.append(trpc)
+
+        else:
+            # Convert each complete \n-delimited packet string to a
+            # TrpcPacket.  Strings that are not valid packets, or not tRPC
+            # packets, are dropped.
+            buf = self.line_buffer
+            buf.extend(data)
+            end = buf.rfind(b'\n') + 1
+            if end:
+                for st in buf[:end].split():
+                    try:
+                        trpc = trpc_msg.TrpcPacket.from_rx_packet(st, pool=self.pool)
+                    except ValueError:
+                        continue
+                    if trpc is not None:
+                        packets.append(trpc)
+                del buf[:end]
+        return packets
+
+
 #******************************************************************************
 class TrpcSocket:
 
     #**************************************************************************
-    def __init__(self, addr = None, port = None):
+    def __init__(self, addr = None, port = None, binary = False, pool = None,
+            buffer_size = 0, flush_delay = FLUSH_DELAY):
         """ Create the socket object with a default host address of 'localhost'
             and a default port ID of 55544.
+
+            If binary is True, packets are exchanged with the packet server
+            as binary frames rather than packet strings (see packet.py).
+
+            If a trpc_msg.PacketPool is given, received packets are decoded in
+            to recycled packets from it, and each one read should be released
+            (or detached) when done with.
+
+            If buffer_size is not 0, written packets are gathered in a buffer
+            and sent together once buffer_size bytes have built up, or once
+            the oldest of them has waited flush_delay seconds (a flush thread
+            of the socket's own sends them then, whatever the caller is
+            doing).  Call flush to send the buffer straight away.
             """
         if addr is None or port is None:
             a, p = get_trpc_host()
@@ -31,7 +130,22 @@ class TrpcSocket:
         self.is_open = False
         self.addr = addr
         self.port = port
-        self.rx_queue = []
+        self.binary = binary
+        self.pool = pool
+        self.reader = None
+        self.rx_queue = collections.deque()
+
+        # Data is received in to recv_buffer and handed to the reader.
+        self.recv_buffer = bytearray(RECV_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+
+        # Written data waiting to be sent, and when it must be sent by.  The
+        # flush thread waits on tx_ready for the deadline.
+        self.buffer_size = buffer_size
+        self.flush_delay = flush_delay
+        self.tx_buffer = bytearray()
+        self.tx_ready = threading.Condition(threading.Lock())
+        self.flush_deadline = None
 
 
     #**************************************************************************
@@ -43,6 +157,22 @@ class TrpcSocket:
         try:
             self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.sock.connect((self.addr, self.port))
+            self.reader = TrpcReader(self.binary, self.pool)
+            self.rx_queue.clear()
+            del self.tx_buffer[:]
+            self.flush_deadline = None
+            if self.buffer_size:
+                # Packets are already gathered here, so Nagle's algorithm
+                # would only hold them up.
+                self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                thread = threading.Thread(target=self.flush_on_time,
+                        args=(self.sock,), name='trpc_sock flush')
+                thread.daemon = True
+                thread.start()
+            if self.binary:
+                # The server echoes the handshake back and the reader switches
+                # to binary frames when it sees it.
+                self.sock.sendall(packet.BINARY_HANDSHAKE)
             self.is_open = True
             return True
 
@@ -57,46 +187,271 @@ class TrpcSocket:
 
     #**************************************************************************
     def close(self):
-        """ Close the socket.
+        """ Close the socket, after sending any buffered writes.
+
+            Another thread can close the socket while this one writes (e.g.
+            the receive thread of a trpc_mux.Multiplexer, when the server
+            closes the connection), so the methods that use the socket take
+            their own reference to it first.  A write then fails with a
+            socket.error, as it would have on the broken connection.
             """
-        if self.sock is not None:
+        sock = self.sock
+        if sock is not None:
+            self.tx_ready.acquire()
             try:
-                self.sock.shutdown(2)
-                self.sock.close()
+                try:
+                    self._flush()
+                except socket.error:
+                    pass
+                # The flush thread stops once the socket is no longer its own.
+                self.sock = None
+                self.tx_ready.notify_all()
+            finally:
+                self.tx_ready.release()
+
+            try:
+                sock.shutdown(2)
+                sock.close()
 
             except socket.error:
                 pass
 
-            self.sock = None
-
             self.is_open = False
 
 
     #**************************************************************************
-    def read(self):
-        """ Read a packet from the socket.  If no packet is avaialble,
-            None is returned.
+    def __iter__(self):
+        """ Iterate over the packets received until the connection is closed,
+            e.g.
+                for p in sock:
+                    print p
+            """
+        return self.packets()
+
 
-            Otherwise a tHA object is returned.
+    #**************************************************************************
+    def packets(self, timeout = None):
+        """ Generate the packets received until the connection is closed, or
+            until no packet has arrived for timeout seconds (see read).
             """
-        if self.sock is not None:
-            if len(self.rx_queue) != 0:
-                return self.rx_queue.pop(0)
+        while True:
+            p = self.read(timeout)
+            if p is None:
+                return
+            yield p
 
-            else:
-                # Receive data from the socket and split it into \n-delimited
-                # strings.  Convert each string to a packet, then use that
-                # packet's data to build a Tn4Packet object.
-                rx_data = self.sock.recv(1024).rsplit('\n')
-                for st in [r for r in rx_data if r]:
-                    self.rx_queue.append(trpc_msg.TrpcPacket.from_rx_packet(st))
+
+    #**************************************************************************
+    def read(self, timeout = 0):
+        """ Read a packet from the socket.  If no packet has been queued, the
+            data waiting on the socket is received first, and if that does
+            not complete a packet, None is returned.
+
+            To wait for a packet instead, give a timeout:  wait for at most
+            timeout seconds, or, if timeout is None, for as long as it takes
+            (as iterating over the socket does).
+
+            Return a TrpcPacket object, or None if there was none, the time
+            ran out or the connection is closed.
+            """
+        if self.wait(timeout):
+            return self.rx_queue.popleft()
         return None
 
 
+    #**************************************************************************
+    def read_many(self, max_count = None, timeout = 0):
+        """ Read every packet that is complete, or at most max_count of them.
+            If no packet has been queued, data is received as read does, and
+            with a timeout, waited for.
+
+            Return a list of TrpcPacket objects, which is empty if there was
+            none, the time ran out or the connection is closed.
+            """
+        packets = []
+        if self.wait(timeout):
+            queue = self.rx_queue
+            if max_count is None or max_count >= len(queue):
+                packets.extend(queue)
+                queue.clear()
+            else:
+                for i in range(max_count):
+                    packets.append(queue.popleft())
+        return packets
+
+
+    #**************************************************************************
+    def wait(self, timeout = None):
+        """ Wait until a packet has been queued, the connection is closed, or
+            timeout seconds have passed (see read).  The socket is only read
+            when select says there is data, so waiting takes no CPU time.
+
+            If the server closes the connection, or the connection fails,
+            the socket is closed.
+
+            Return True if a packet is queued.
+            """
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while not self.rx_queue:
+            sock = self.sock
+            if sock is None:
+                break
+            wait_time = None
+            if timeout is not None:
+                wait_time = max(deadline - time.time(), 0)
+
+            readable, _, _ = select.select([sock], [], [], wait_time)
+            if readable:
+                try:
+                    closed = self.receive() == 0
+                except socket.error:
+                    closed = True
+                if closed:
+                    self.close()
+
+            elif timeout is not None and time.time() >= deadline:
+                break
+
+        return len(self.rx_queue) != 0
+
+
+    #**************************************************************************
+    def receive(self):
+        """ Receive data from the socket (waiting for it if there is none)
+            and queue the packets that it completes.  Partial packets are
+            kept until the rest of them arrives.
+
+            Return the number of bytes received, which is 0 if the
+            connection is closed.
+            """
+        sock = self.sock
+        if sock is None:
+            return 0
+        n = sock.recv_into(self.recv_view)
+        self.rx_queue.extend(self.reader.feed(self.recv_view[:n]))
+        return n
+
+
     #**************************************************************************
     def write(self, trpc_packet):
         """ Write a TrpcPacket object to the socket.
             """
-        if self.sock is not None:
-            self.sock.send(str(trpc_packet.to_tpck()))
+        self.send(encode(trpc_packet, self.binary))
+
+
+    #**************************************************************************
+    def write_many(self, trpc_packets):
+        """ Write a sequence of TrpcPacket objects to the socket.  They are
+            sent together, in one system call if the socket allows it.
+            """
+        binary = self.binary
+        self.send(b''.join([encode(p, binary) for p in trpc_packets]))
+
+
+    #**************************************************************************
+    def send(self, data):
+        """ Send encoded packets, or add them to the write buffer if there is
+            one.  Complete packets are always sent, never part of one.  If
+            the socket is closed, the data is dropped.
+            """
+        sock = self.sock
+        if sock is None:
+            return
+        if not self.buffer_size:
+            sock.sendall(data)
+        else:
+            self.tx_ready.acquire()
+            try:
+                buf = self.tx_buffer
+                if not buf:
+                    # The first write to an empty buffer sets the deadline.
+                    self.flush_deadline = time.time() + self.flush_delay
+                    self.tx_ready.notify_all()
+                buf.extend(data)
+                if len(buf) >= self.buffer_size:
+                    self._flush()
+            finally:
+                self.tx_ready.release()
+
+
+    #**************************************************************************
+    def add_filter(self, services = None, methods = None, addresses = None):
+        """ Ask the packet server to send only the tRPC packets that match a
+            filter (see trpc_msg.RouteFilter), e.g.
+                sock.add_filter(methods = ['CurrentTemperature'])
+
+            Filters add up:  a packet that matches any of them is sent.  Until
+            the first filter is added, every packet is sent.
+            """
+        f = trpc_msg.RouteFilter(services, methods, addresses)
+        self.control(f.to_command())
+
+
+    #**************************************************************************
+    def clear_filters(self):
+        """ Remove the filters, so that the packet server sends every packet
+            again.
+            """
+        self.control('CLEAR')
+
+
+    #**************************************************************************
+    def control(self, command):
+        """ Send a command to the packet server (see packserv.py).
+            """
+        p = packet.Packet(packet.TYPE_CONTROL, bytearray(command.encode('ascii')))
+        self.send(encode_packet(p, self.binary))
+
+
+    #**************************************************************************
+    def flush(self):
+        """ Send the buffered writes, if any.
+            """
+        self.tx_ready.acquire()
+        try:
+            self._flush()
+        finally:
+            self.tx_ready.release()
+
+
+    #**************************************************************************
+    def flush_on_time(self, sock):
+        """ Send the buffered writes whenever their deadline is up, until the
+            socket is closed (or opened again).  This is the flush thread,
+            one for each open socket with a write buffer.
+            """
+        ready = self.tx_ready
+        ready.acquire()
+        try:
+            while self.sock is sock:
+                if self.flush_deadline is None:
+                    ready.wait()
+                    continue
+                wait_time = self.flush_deadline - time.time()
+                if wait_time > 0:
+                    ready.wait(wait_time)
+                    continue
+                try:
+                    self._flush()
+                except socket.error:
+                    # The connection failed.  The owner finds out from its
+                    # next read or write.
+                    pass
+        finally:
+            ready.release()
+
+
+    #**************************************************************************
+    def _flush(self):
+        """ Send the buffered writes.  The caller holds tx_ready.
+            """
+        self.flush_deadline = None
+        sock = self.sock
+        if self.tx_buffer and sock is not None:
+            try:
+                sock.sendall(self.tx_buffer)
+            finally:
+                del self.tx_buffer[:]
 
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+""" Columnar decoding of tRPC captures.
+
+    A capture is turned in to one NumPy table (structured array) per method:
+    a timestamp column, a serviceID column and a column per body field of the
+    method (see trpc_msg.method_formats).  Packets are grouped by method ID
+    and each group is decoded in one vectorized pass, rather than a
+    TrpcPacket at a time.
+
+    Example, the average temperature reported by each address:
+        import numpy
+        import trpc_msg
+        import trpc_tables
+
+        tables = trpc_tables.from_lines(open('capture.txt'))
+        t = tables[trpc_msg.methodID_from_name['CurrentTemperature']]
+        addresses, index = numpy.unique(t['address'], return_inverse=True)
+        averages = numpy.bincount(index, t['temp']) / numpy.bincount(index)
+
+    Packets of unknown methods, and packets too short for their method, are
+    left out.  Any extra data after the body is ignored.
+    """
+
+
+#*****************************************************************************
+import binascii
+import numpy
+import packet
+import tpck
+import trpc_msg
+from fields import FieldList
+
+
+#*****************************************************************************
+_trpc_type = bytes(bytearray([packet.TYPE_TRPC]))
+_header = trpc_msg.TrpcPacket.format
+_methodID_start = trpc_msg._methodID_offset
+_methodID_end = _methodID_start + trpc_msg._methodID_struct.size
+
+# Combined header and body field lists, by method ID, made as needed.
+_table_formats = {}
+
+
+#*****************************************************************************
+def from_lines(lines):
+    """ Decode a capture of packet strings, one per line, as sent by
+        packserv.  A line may start with a timestamp (seconds, as a float)
+        separated from the packet by white space; otherwise the timestamp is
+        NaN.  Lines that are not tRPC packets are skipped.
+
+        Return a dictionary of tables by method ID.
+        """
+    payloads = []
+    stamps = []
+    nan = float('nan')
+    for line in lines:
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            data = binascii.unhexlify(parts[-1])
+            if len(parts) > 1:
+                stamp = float(parts[0])
+            else:
+                stamp = nan
+        except (TypeError, ValueError):
+            # Odd length, not hex, or a bad timestamp.
+            continue
+        if data[:1] == _trpc_type:
+            payloads.append(data[1:])
+            stamps.append(stamp)
+    return tables(payloads, stamps)
+
+
+#*****************************************************************************
+def from_tpck(stream, stamp=float('nan')):
+    """ Decode a capture of raw tpck bytes (str, bytearray, ...).  There are
+        no timestamps in the stream, so every packet is given the one passed
+        in.
+
+        Return a dictionary of tables by method ID.
+        """
+    payloads = [bytes(p.data) for p in tpck.TpckParser().feed(stream)
+            if p.type == packet.TYPE_TRPC]
+    return tables(payloads, [stamp] * len(payloads))
+
+
+#*****************************************************************************
+def tables(payloads, stamps):
+    """ Group tRPC payloads (str or bytes, each the data of a packet) by
+        method and decode each group.  stamps holds the timestamp of each
+        payload.
+
+        Return a dictionary of tables by method ID.
+        """
+    groups = {}
+    for data, stamp in zip(payloads, stamps):
+        key = data[_methodID_start:_methodID_end]
+        try:
+            group = groups[key]
+        except KeyError:
+            group = groups[key] = ([], [])
+        group[0].append(data)
+        group[1].append(stamp)
+
+    result = {}
+    for key, (group, group_stamps) in groups.items():
+        if len(key) < _methodID_end - _methodID_start:
+            continue
+        methodID = trpc_msg._methodID_struct.unpack(key)[0]
+        if methodID in trpc_msg.method_formats:
+            result[methodID] = decode_group(methodID, group, group_stamps)
+    return result
+
+
+#*****************************************************************************
+def table_format(methodID):
+    """ Return the FieldList of the header and body of a method together.
+        """
+    try:
+        return _table_formats[methodID]
+    except KeyError:
+        body = trpc_msg.method_formats[methodID]
+        fmt = FieldList(body.name, *(tuple(_header.fields) + tuple(body.fields)))
+        _table_formats[methodID] = fmt
+        return fmt
+
+
+#*****************************************************************************
+def decode_group(methodID, payloads, stamps):
+    """ Decode payloads that all have the same method ID in one pass.
+
+        Return the method's table.
+        """
+    fmt = table_format(methodID)
+    size = fmt.size
+    keep = [i for i, data in enumerate(payloads) if len(data) >= size]
+    if len(keep) < len(payloads):
+        payloads = [payloads[i] for i in keep]
+        stamps = [stamps[i] for i in keep]
+
+    # Cut every payload down to the same size so that they can be decoded as
+    # an array of records.
+    raw = fmt.unpack_many(b''.join([bytes(data[:size]) for data in payloads]))
+
+    names = ['serviceID'] + list(trpc_msg.method_formats[methodID].field_names)
+    dtype = [('timestamp', 'f8')] + [(n, raw.dtype[n]) for n in names]
+    table = numpy.empty(len(raw), dtype)
+    table['timestamp'] = stamps
+    for n in names:
+        table[n] = raw[n]
+    return table